@@ -142,12 +142,37 @@ FACIAL_RECOGNITION_ENABLED = True
 FACIAL_CONFIDENCE_THRESHOLD = 0.6
 FACIAL_MAX_ATTEMPTS = 3
 FACIAL_ATTEMPT_TIMEOUT = 300  # 5 minutos em segundos
+# Detector facial: 'hog' (CPU) ou 'cnn' (GPU quando o dlib foi compilado com CUDA).
+# Se None, usa 'cnn' automaticamente quando o dlib tiver suporte a CUDA.
+FACIAL_DETECTION_MODEL = None
+# Maior lado (em pixels) da imagem usada na detecção; as caixas são reprojetadas
+# na imagem original para extrair o encoding em resolução completa. Os frames da
+# câmera já são reduzidos a este tamanho logo após a decodificação, antes do
+# encoding e do armazenamento. 0 desativa.
+FACIAL_DETECT_MAXSIDE = 640
+# Validação de liveness, feita sempre na resolução original da imagem: limiares
+# de nitidez (variância do Laplaciano) e entropia do histograma.
+FACIAL_LIVENESS_MIN_SHARPNESS = 100
+FACIAL_LIVENESS_MIN_ENTROPY = 4.5
+# Acima deste número de usuários com facial ativo, o login pré-filtra candidatos
+# com um índice HNSW do faiss (quando instalado). 0 desativa (padrão): a busca
+# exata é um único produto matriz-vetor e só compensa trocar com ~50000+ usuários.
+FACIAL_ANN_MIN_USERS = 0
+# Grava os registros de acesso facial (e suas fotos) durante a requisição. True
+# passa a gravá-los em lotes por uma thread de segundo plano, fora do tempo de
+# resposta, mas a fila fica em memória: registros de auditoria pendentes se perdem
+# se o processo for morto (SIGKILL, OOM, reciclagem do worker).
+FACIAL_AUDIT_ASYNC = False
 
 # Chave de criptografia para encodings faciais (em produção, use variável de ambiente)
 import base64
 FACIAL_ENCRYPTION_KEY = base64.urlsafe_b64encode(SECRET_KEY[:32].encode().ljust(32, b'0'))[:44]
 
-# Configurações de Cache (para controle de tentativas)
+# Configurações de Cache (para controle de tentativas e matriz do login facial)
+# O LocMemCache é por processo: com vários workers, a invalidação da matriz de
+# encodings só vale no processo que a fez. O login facial confere o usuário no
+# banco antes de autenticar, mas em produção use um cache compartilhado
+# (Redis/memcached/DatabaseCache) para que todos os workers vejam a nova versão.
 CACHES = {
     'default': {
         'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
@@ -2,18 +2,33 @@ from django.contrib import admin, messages
 from django.contrib.auth.admin import UserAdmin
 from django.core.exceptions import ValidationError
 from django import forms
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Case, IntegerField, Value, When
 from django.utils.html import format_html
 from django.urls import reverse
 from django.utils.safestring import mark_safe
-from .models import Usuario, Grupo, RegistroAcessoFacial
+from .models import Usuario, Grupo, RegistroAcessoFacial, ADMIN_GRUPOS_SECUNDARIOS_LOOKUPS_KEY, ADMIN_GRUPO_PAI_LOOKUPS_KEY
 
-# Verificação de disponibilidade de reconhecimento facial
-try:
-    import cv2
-    import numpy as np
-    FACIAL_RECOGNITION_AVAILABLE = True
-except ImportError:
-    FACIAL_RECOGNITION_AVAILABLE = False
+# Fragmentos HTML fixos das colunas do admin, montados uma única vez
+_STATUS_ATIVO = mark_safe('<span style="color: green;"><strong>✓ Ativo</strong></span>')
+_STATUS_PERMITIDO = mark_safe('<span style="color: orange;">⚠ Permitido</span>')
+_STATUS_SEM_PERMISSAO = mark_safe('<span style="color: red;">✗ Sem Permissão</span>')
+_STATUS_FACIAL = {2: _STATUS_ATIVO, 1: _STATUS_PERMITIDO, 0: _STATUS_SEM_PERMISSAO}
+_FOTO_FACIAL_VAZIA = mark_safe(
+    '<div style="text-align: center; padding: 20px; border: 2px dashed #ccc; border-radius: 8px; background: #f9f9f9;">'
+    '<span style="color: #999; font-size: 24px;">📷</span><br>'
+    '<small style="color: #666;">Nenhuma foto cadastrada</small>'
+    '</div>'
+)
+_FOTO_FACIAL_TMPL = (
+    '<div style="text-align: center;">'
+    '<img src="{}" width="120" height="120" style="object-fit: cover; border-radius: 8px; border: 2px solid #ddd; box-shadow: 0 2px 4px rgba(0,0,0,0.1);" />'
+    '<br><small style="color: #666; margin-top: 5px; display: inline-block;">Foto de referência</small>'
+    '</div>'
+)
+_THUMB_TMPL = '<img src="{}" width="50" height="50" style="object-fit: cover; border-radius: 4px;" />'
+_FOTO_COMPLETA_TMPL = '<img src="{}" style="max-width: 300px; max-height: 300px; object-fit: contain; border-radius: 8px;" />'
 
 
 class UsuarioAdminForm(forms.ModelForm):
@@ -33,8 +48,13 @@ class UsuarioAdminForm(forms.ModelForm):
             raise ValidationError('O setor principal deve estar ativo.')
         
         # Validação para evitar duplicação entre setor principal e secundários
-        if grupo_primario and grupos_secundarios:
-            if grupo_primario in grupos_secundarios:
+        if grupo_primario and grupos_secundarios is not None:
+            if hasattr(grupos_secundarios, 'values_list'):
+                secundarios_ids = set(grupos_secundarios.values_list('pk', flat=True))
+            else:
+                secundarios_ids = {grupo.pk for grupo in grupos_secundarios}
+            
+            if grupo_primario.pk in secundarios_ids:
                 raise ValidationError({
                     'grupos_secundarios': f'O setor "{grupo_primario.nome}" já está definido como principal. '
                                           'Não pode ser selecionado também como secundário.'
@@ -54,20 +74,42 @@ class GrupoAdminForm(forms.ModelForm):
             if grupo_pai == self.instance:
                 raise ValidationError('Um grupo não pode ser pai de si mesmo.')
             
-            if self.instance in grupo_pai.get_todos_subgrupos():
+            # O caminho materializado do pai escolhido indica se ele é um subgrupo
+            if grupo_pai.pertence_a_subarvore(self.instance):
                 raise ValidationError('Não é possível definir um subgrupo como pai.')
         return grupo_pai
 
 
+class GrupoPaiFilter(admin.SimpleListFilter):
+    """Filtro por grupo pai com as opções (grupos que possuem subgrupos) em cache."""
+    title = 'Grupo Pai'
+    parameter_name = 'grupo_pai'
+    
+    def lookups(self, request, model_admin):
+        return cache.get_or_set(
+            ADMIN_GRUPO_PAI_LOOKUPS_KEY,
+            lambda: list(
+                Grupo.objects.filter(subgrupos__isnull=False).distinct().order_by('hierarquia_cache').values_list('id', 'hierarquia_cache')
+            ),
+            300
+        )
+    
+    def queryset(self, request, queryset):
+        if self.value():
+            return queryset.filter(grupo_pai__id=self.value())
+        return queryset
+
+
 @admin.register(Grupo)
 class GrupoAdmin(admin.ModelAdmin):
     form = GrupoAdminForm
     list_display = ('exibir_hierarquia', 'nome', 'grupo_pai', 'ativo', 'permite_uso_reconhecimento_facial', 'obriga_reconhecimento_facial', 'exibir_usuarios_primarios', 'exibir_usuarios_secundarios', 'data_criacao')
-    list_filter = ('ativo', 'permite_uso_reconhecimento_facial', 'obriga_reconhecimento_facial', 'data_criacao', 'grupo_pai')
+    list_filter = ('ativo', 'permite_uso_reconhecimento_facial', 'obriga_reconhecimento_facial', 'data_criacao', GrupoPaiFilter)
     search_fields = ('nome', 'descricao', 'grupo_pai__nome')
     list_editable = ('ativo', 'permite_uso_reconhecimento_facial', 'obriga_reconhecimento_facial')
     readonly_fields = ('data_criacao', 'data_atualizacao', 'exibir_hierarquia_completa', 'exibir_nivel')
     ordering = ('nome',)
+    list_select_related = ('grupo_pai',)
     
     fieldsets = (
         ('Informações Básicas', {
@@ -89,24 +131,24 @@ class GrupoAdmin(admin.ModelAdmin):
 
     def exibir_hierarquia(self, obj):
         """Exibe a hierarquia com indentação visual."""
-        nivel = obj.get_nivel_hierarquia()
+        nivel = obj.nivel_cache
         indentacao = '—' * nivel
         return f"{indentacao} {obj.nome}" if nivel > 0 else obj.nome
     exibir_hierarquia.short_description = 'Hierarquia'
 
     def exibir_hierarquia_completa(self, obj):
         """Exibe o caminho completo da hierarquia."""
-        return obj.get_hierarquia_completa()
+        return obj.hierarquia_cache
     exibir_hierarquia_completa.short_description = 'Caminho Completo'
 
     def exibir_nivel(self, obj):
         """Exibe o nível na hierarquia."""
-        return obj.get_nivel_hierarquia()
+        return obj.nivel_cache
     exibir_nivel.short_description = 'Nível na Hierarquia'
 
     def get_queryset(self, request):
-        """Otimiza consultas incluindo grupo_pai."""
-        return super().get_queryset(request).select_related('grupo_pai')
+        """Otimiza consultas incluindo o grupo pai e a contagem de usuários."""
+        return super().get_queryset(request).select_related('grupo_pai').com_contagens()
     
     def has_module_permission(self, request):
         """Permite acesso ao módulo apenas para staff."""
@@ -114,48 +156,48 @@ class GrupoAdmin(admin.ModelAdmin):
     
     def exibir_usuarios_primarios(self, obj):
         """Exibe a quantidade de usuários no setor principal."""
-        count = obj.get_usuarios_primarios_count()
+        count = obj._usuarios_primarios_count
         return f"{count} usuário{'s' if count != 1 else ''}"
     exibir_usuarios_primarios.short_description = 'Setor Principal'
+    exibir_usuarios_primarios.admin_order_field = '_usuarios_primarios_count'
     
     def exibir_usuarios_secundarios(self, obj):
         """Exibe a quantidade de usuários nos setores secundários."""
-        count = obj.get_usuarios_secundarios_count()
+        count = obj._usuarios_secundarios_count
         return f"{count} usuário{'s' if count != 1 else ''}"
     exibir_usuarios_secundarios.short_description = 'Setores Secundários'
+    exibir_usuarios_secundarios.admin_order_field = '_usuarios_secundarios_count'
 
 
-class RegistroAcessoFacialInline(admin.TabularInline):
-    model = RegistroAcessoFacial
-    extra = 0
-    readonly_fields = ('data_hora', 'tipo_acesso', 'confianca', 'ip_origem', 'sucesso', 'observacoes', 'dispositivo', 'exibir_foto_miniatura')
-    fields = ('data_hora', 'tipo_acesso', 'confianca', 'sucesso', 'ip_origem', 'observacoes', 'exibir_foto_miniatura')
-    can_delete = False
+class GrupoSecundarioFilter(admin.SimpleListFilter):
+    """Filtro por setor secundário com as opções de grupos ativos em cache."""
+    title = 'Setor Secundário'
+    parameter_name = 'grupos_secundarios'
     
-    def has_add_permission(self, request, obj=None):
-        return False
+    def lookups(self, request, model_admin):
+        return cache.get_or_set(
+            ADMIN_GRUPOS_SECUNDARIOS_LOOKUPS_KEY,
+            lambda: list(Grupo.objects.filter(ativo=True).order_by('hierarquia_cache').values_list('id', 'hierarquia_cache')),
+            300
+        )
     
-    def exibir_foto_miniatura(self, obj):
-        if obj.foto_capturada:
-            return format_html(
-                '<img src="{}" width="50" height="50" style="object-fit: cover; border-radius: 4px;" />',
-                obj.foto_capturada.url
-            )
-        return "Sem foto"
-    exibir_foto_miniatura.short_description = "Foto"
+    def queryset(self, request, queryset):
+        if self.value():
+            return queryset.filter(grupos_secundarios__id=self.value())
+        return queryset
 
 
 @admin.register(Usuario)
 class UsuarioAdmin(UserAdmin):
     form = UsuarioAdminForm
     list_display = ('username', 'email', 'first_name', 'last_name', 'exibir_grupo_primario', 'telefone', 'ativo', 'exibir_status_facial', 'data_criacao')
-    list_filter = ('ativo', 'reconhecimento_facial_ativo', 'permite_reconhecimento_facial', 'data_criacao', 'is_staff', 'is_active', 'grupo_primario', 'grupos_secundarios')
+    list_filter = ('ativo', 'reconhecimento_facial_ativo', 'permite_reconhecimento_facial', 'data_criacao', 'is_staff', 'is_active', 'grupo_primario', GrupoSecundarioFilter)
     search_fields = ('username', 'email', 'first_name', 'last_name', 'grupo_primario__nome')
     list_editable = ('ativo',)
-    readonly_fields = ('data_criacao', 'data_atualizacao', 'last_login', 'date_joined', 'exibir_foto_facial', 'data_cadastro_facial', 'ultimo_acesso_facial')
+    readonly_fields = ('data_criacao', 'data_atualizacao', 'last_login', 'date_joined', 'exibir_foto_facial', 'data_cadastro_facial', 'ultimo_acesso_facial', 'exibir_registros_faciais')
     ordering = ('username',)
+    list_select_related = ('grupo_primario',)
     filter_horizontal = ('grupos_secundarios',)
-    inlines = [RegistroAcessoFacialInline]
     
     actions = ['ativar_reconhecimento_facial', 'desativar_reconhecimento_facial', 'remover_dados_faciais', 'processar_fotos_pendentes']
     
@@ -164,7 +206,7 @@ class UsuarioAdmin(UserAdmin):
             'fields': ('grupo_primario', 'grupos_secundarios')
         }),
         ('Reconhecimento Facial', {
-            'fields': ('permite_reconhecimento_facial', 'reconhecimento_facial_ativo', 'foto_perfil_facial', 'exibir_foto_facial', 'data_cadastro_facial', 'ultimo_acesso_facial', 'tentativas_falhas_facial'),
+            'fields': ('permite_reconhecimento_facial', 'reconhecimento_facial_ativo', 'foto_perfil_facial', 'exibir_foto_facial', 'data_cadastro_facial', 'ultimo_acesso_facial', 'tentativas_falhas_facial', 'exibir_registros_faciais'),
             'description': 'Configurações e status do reconhecimento facial do usuário. Faça upload de uma foto clara do rosto para ativar o reconhecimento facial.'
         }),
         ('Informações Adicionais', {
@@ -184,54 +226,61 @@ class UsuarioAdmin(UserAdmin):
     def exibir_grupo_primario(self, obj):
         """Exibe o setor principal do usuário."""
         if obj.grupo_primario:
-            return obj.grupo_primario.get_hierarquia_completa()
+            return obj.grupo_primario.hierarquia_cache
         return '-'
     exibir_grupo_primario.short_description = 'Setor Principal'
     
     def get_queryset(self, request):
-        """Otimiza consultas incluindo grupos."""
-        return super().get_queryset(request).select_related('grupo_primario').prefetch_related('grupos_secundarios')
+        """Otimiza consultas incluindo grupos e o status facial, sem carregar o encoding facial."""
+        return super().get_queryset(request).select_related(
+            'grupo_primario'
+        ).prefetch_related('grupos_secundarios').annotate(
+            _status_facial=Case(
+                When(reconhecimento_facial_ativo=True, then=Value(2)),
+                When(permite_reconhecimento_facial=True, then=Value(1)),
+                default=Value(0),
+                output_field=IntegerField(),
+            )
+        )
+    
+    def _grupos_ativos_qs(self):
+        """Grupos ativos; o rótulo de cada opção vem da hierarquia em cache, sem joins."""
+        return Grupo.objects.filter(ativo=True)
     
     def formfield_for_foreignkey(self, db_field, request, **kwargs):
         """Customiza o campo de setor principal para mostrar apenas grupos ativos."""
         if db_field.name == 'grupo_primario':
-            kwargs['queryset'] = Grupo.objects.filter(ativo=True)
+            kwargs['queryset'] = self._grupos_ativos_qs()
         return super().formfield_for_foreignkey(db_field, request, **kwargs)
     
     def formfield_for_manytomany(self, db_field, request, **kwargs):
         """Customiza o campo de setores secundários para mostrar apenas grupos ativos."""
         if db_field.name == 'grupos_secundarios':
-            kwargs['queryset'] = Grupo.objects.filter(ativo=True)
+            kwargs['queryset'] = self._grupos_ativos_qs()
         return super().formfield_for_manytomany(db_field, request, **kwargs)
     
     def exibir_status_facial(self, obj):
-        """Exibe o status do reconhecimento facial."""
-        if obj.reconhecimento_facial_ativo:
-            return format_html('<span style="color: green;"><strong>✓ Ativo</strong></span>')
-        elif obj.permite_reconhecimento_facial:
-            return format_html('<span style="color: orange;">⚠ Permitido</span>')
-        else:
-            return format_html('<span style="color: red;">✗ Sem Permissão</span>')
+        """Exibe o status do reconhecimento facial, calculado na consulta."""
+        return _STATUS_FACIAL[obj._status_facial]
     exibir_status_facial.short_description = 'Status Facial'
+    exibir_status_facial.admin_order_field = '_status_facial'
     
     def exibir_foto_facial(self, obj):
         """Exibe a foto facial do usuário no admin com melhor formatação."""
         if obj.foto_perfil_facial:
-            return format_html(
-                '<div style="text-align: center;">'
-                '<img src="{}" width="120" height="120" style="object-fit: cover; border-radius: 8px; border: 2px solid #ddd; box-shadow: 0 2px 4px rgba(0,0,0,0.1);" />'
-                '<br><small style="color: #666; margin-top: 5px; display: inline-block;">Foto de referência</small>'
-                '</div>',
-                obj.foto_perfil_facial.url
-            )
-        return format_html(
-            '<div style="text-align: center; padding: 20px; border: 2px dashed #ccc; border-radius: 8px; background: #f9f9f9;">'
-            '<span style="color: #999; font-size: 24px;">📷</span><br>'
-            '<small style="color: #666;">Nenhuma foto cadastrada</small>'
-            '</div>'
-        )
+            return format_html(_FOTO_FACIAL_TMPL, obj.foto_perfil_facial.url)
+        return _FOTO_FACIAL_VAZIA
     exibir_foto_facial.short_description = "Foto de Referência Facial"
     
+    def exibir_registros_faciais(self, obj):
+        """Exibe um link para o histórico de acessos faciais do usuário, paginado no admin."""
+        if not obj.pk:
+            return '-'
+        count = obj.registros_faciais.count()
+        url = reverse('admin:usuarios_registroacessofacial_changelist') + f'?usuario__id__exact={obj.pk}'
+        return format_html('<a href="{}">Ver {} registro(s) de acesso facial</a>', url, count)
+    exibir_registros_faciais.short_description = "Registros de Acesso Facial"
+    
     def ativar_reconhecimento_facial(self, request, queryset):
         """Action para ativar permissão de reconhecimento facial."""
         updated = queryset.update(permite_reconhecimento_facial=True)
@@ -241,52 +290,58 @@ class UsuarioAdmin(UserAdmin):
     def desativar_reconhecimento_facial(self, request, queryset):
         """Action para desativar permissão de reconhecimento facial."""
         updated = queryset.update(permite_reconhecimento_facial=False, reconhecimento_facial_ativo=False)
+        Usuario.invalidar_cache_encodings()
         self.message_user(request, f'{updated} usuário(s) teve(ram) o reconhecimento facial desabilitado.')
     desativar_reconhecimento_facial.short_description = "Desativar reconhecimento facial"
     
     def remover_dados_faciais(self, request, queryset):
         """Action para remover todos os dados faciais dos usuários selecionados."""
-        count = 0
-        for usuario in queryset:
-            if usuario.reconhecimento_facial_ativo:
-                usuario.face_encoding = None
-                usuario.reconhecimento_facial_ativo = False
-                usuario.data_cadastro_facial = None
-                usuario.tentativas_falhas_facial = 0
-                if usuario.foto_perfil_facial:
-                    usuario.foto_perfil_facial.delete()
-                usuario.save()
-                count += 1
+        queryset = queryset.filter(reconhecimento_facial_ativo=True)
+        storage = Usuario._meta.get_field('foto_perfil_facial').storage
+        
+        with transaction.atomic():
+            fotos = [
+                nome for nome in queryset.values_list('foto_perfil_facial', flat=True) if nome
+            ]
+            count = queryset.update(
+                face_encoding=None,
+                reconhecimento_facial_ativo=False,
+                data_cadastro_facial=None,
+                tentativas_falhas_facial=0,
+                foto_perfil_facial='',
+            )
+            
+            def remover_arquivos():
+                for nome in fotos:
+                    storage.delete(nome)
+            
+            # Remove os arquivos das fotos somente após o commit, quando o banco já não os referencia
+            transaction.on_commit(remover_arquivos)
+            transaction.on_commit(Usuario.invalidar_cache_encodings)
         
         self.message_user(request, f'Dados faciais removidos para {count} usuário(s).')
     remover_dados_faciais.short_description = "Remover dados faciais"
     
     def processar_fotos_pendentes(self, request, queryset):
         """Action para processar fotos que foram enviadas mas não têm encoding."""
-        if not FACIAL_RECOGNITION_AVAILABLE:
+        # Importa as bibliotecas nativas apenas quando a action é executada
+        try:
+            import cv2
+            import numpy as np
+        except ImportError:
             self.message_user(request, 'Reconhecimento facial não está disponível.', level=messages.ERROR)
             return
-            
-        count_processados = 0
-        count_falhas = 0
         
-        for usuario in queryset:
-            if usuario.foto_perfil_facial and not usuario.face_encoding:
-                try:
-                    from .facial_security import FacialSecurityManager
-                    manager = FacialSecurityManager()
-                    
-                    # Processa a imagem para extrair encoding facial
-                    success = manager.processar_nova_foto_usuario(usuario)
-                    
-                    if success:
-                        count_processados += 1
-                    else:
-                        count_falhas += 1
-                        
-                except Exception as e:
-                    count_falhas += 1
-                    print(f"Erro ao processar foto do usuário {usuario.username}: {e}")
+        pendentes = queryset.filter(
+            face_encoding__isnull=True, foto_perfil_facial__isnull=False
+        ).exclude(foto_perfil_facial='').select_related(None).prefetch_related(None).only(
+            'id', 'username', 'foto_perfil_facial', 'face_encoding_version'
+        )
+        
+        from .facial_security import facial_manager
+        
+        # Processa as imagens em paralelo para extrair os encodings faciais
+        count_processados, count_falhas = facial_manager.processar_fotos_em_lote(pendentes)
         
         if count_processados > 0:
             self.message_user(request, f'{count_processados} foto(s) processada(s) com sucesso.')
@@ -303,6 +358,7 @@ class RegistroAcessoFacialAdmin(admin.ModelAdmin):
     search_fields = ('usuario__username', 'usuario__first_name', 'usuario__last_name', 'ip_origem', 'observacoes')
     readonly_fields = ('usuario', 'data_hora', 'tipo_acesso', 'confianca', 'ip_origem', 'sucesso', 'observacoes', 'dispositivo', 'exibir_foto_completa')
     ordering = ('-data_hora',)
+    list_select_related = ('usuario',)
     
     fieldsets = (
         ('Informações do Acesso', {
@@ -316,6 +372,17 @@ class RegistroAcessoFacialAdmin(admin.ModelAdmin):
         }),
     )
     
+    def get_queryset(self, request):
+        """Carrega o usuário junto e, na listagem, apenas as colunas exibidas."""
+        queryset = super().get_queryset(request).select_related('usuario')
+        # A tela de detalhe exibe todos os campos: restringir as colunas ali só geraria consultas adiadas
+        if request.resolver_match and request.resolver_match.url_name == 'usuarios_registroacessofacial_changelist':
+            queryset = queryset.only(
+                'id', 'data_hora', 'tipo_acesso', 'confianca', 'sucesso', 'ip_origem', 'foto_capturada',
+                'usuario__username', 'usuario__first_name', 'usuario__last_name'
+            )
+        return queryset
+    
     def has_add_permission(self, request):
         return False
     
@@ -324,18 +391,12 @@ class RegistroAcessoFacialAdmin(admin.ModelAdmin):
     
     def exibir_foto_miniatura(self, obj):
         if obj.foto_capturada:
-            return format_html(
-                '<img src="{}" width="50" height="50" style="object-fit: cover; border-radius: 4px;" />',
-                obj.foto_capturada.url
-            )
+            return format_html(_THUMB_TMPL, obj.foto_capturada.url)
         return "Sem foto"
     exibir_foto_miniatura.short_description = "Foto"
     
     def exibir_foto_completa(self, obj):
         if obj.foto_capturada:
-            return format_html(
-                '<img src="{}" style="max-width: 300px; max-height: 300px; object-fit: contain; border-radius: 8px;" />',
-                obj.foto_capturada.url
-            )
+            return format_html(_FOTO_COMPLETA_TMPL, obj.foto_capturada.url)
         return "Sem foto capturada"
     exibir_foto_completa.short_description = "Foto Capturada"
\ No newline at end of file
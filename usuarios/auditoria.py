@@ -0,0 +1,168 @@
+import atexit
+import logging
+import queue
+import threading
+import time
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.db import close_old_connections
+from django.utils import timezone
+
+# OpenCV é opcional: sem ele, imagens em array não podem ser codificadas
+try:
+    import cv2
+    CV2_AVAILABLE = True
+except ImportError:
+    CV2_AVAILABLE = False
+
+logger = logging.getLogger(__name__)
+
+# Registros acumulados por gravação e tempo máximo de espera por um lote completo
+AUDIT_BATCH_SIZE = 32
+AUDIT_FLUSH_INTERVAL = 0.1
+
+# Tempo máximo, no encerramento do processo, à espera do lote que o worker está gravando
+AUDIT_EXIT_TIMEOUT = 5
+
+# Qualidade das fotos de acesso gravadas em WebP (bem menores que o JPEG equivalente)
+AUDIT_WEBP_QUALITY = 80
+
+_AUDIT_QUEUE = queue.Queue()
+_worker = None
+_worker_lock = threading.Lock()
+
+
+def registrar_acesso(foto_nome=None, foto_bytes=None, foto_imagem=None, **campos):
+    """
+    Registra um acesso facial na hora ou por uma fila de segundo plano.
+
+    Os campos são os de RegistroAcessoFacial; a foto, quando informada, é
+    gravada no storage junto com o registro. Ela pode vir já codificada
+    (foto_bytes) ou como array OpenCV (foto_imagem), codificado em WebP na
+    gravação. Por padrão (FACIAL_AUDIT_ASYNC = False) a gravação é feita na
+    hora; no modo assíncrono a fila fica em memória e registros ainda não
+    gravados se perdem se o processo for morto.
+    """
+    usuario = campos.pop('usuario', None)
+    if usuario is not None:
+        campos['usuario_id'] = usuario.pk
+    # O horário é o do acesso, não o da gravação do lote
+    campos.setdefault('data_hora', timezone.now())
+    item = (campos, foto_nome, foto_bytes, foto_imagem)
+
+    if not getattr(settings, 'FACIAL_AUDIT_ASYNC', False):
+        _gravar_lote([item])
+        return
+
+    _iniciar_worker()
+    _AUDIT_QUEUE.put(item)
+
+
+def _iniciar_worker():
+    """Inicia a thread de gravação na primeira utilização do processo."""
+    global _worker
+    if _worker is not None and _worker.is_alive():
+        return
+    with _worker_lock:
+        if _worker is None or not _worker.is_alive():
+            _worker = threading.Thread(target=_processar_fila, name='auditoria-facial', daemon=True)
+            _worker.start()
+
+
+def _processar_fila():
+    """Agrupa os registros da fila em lotes de até AUDIT_BATCH_SIZE ou AUDIT_FLUSH_INTERVAL."""
+    while True:
+        itens = [_AUDIT_QUEUE.get()]
+        limite = time.monotonic() + AUDIT_FLUSH_INTERVAL
+        while len(itens) < AUDIT_BATCH_SIZE:
+            restante = limite - time.monotonic()
+            if restante <= 0:
+                break
+            try:
+                itens.append(_AUDIT_QUEUE.get(timeout=restante))
+            except queue.Empty:
+                break
+        try:
+            _gravar_lote(itens)
+        finally:
+            for _ in itens:
+                _AUDIT_QUEUE.task_done()
+
+
+def _gravar_lote(itens):
+    """
+    Codifica e grava as fotos e insere os registros com um único bulk_create.
+
+    Se o lote falhar, os registros são gravados um a um e apenas os que
+    falharem de novo são descartados.
+    """
+    from .models import RegistroAcessoFacial
+
+    try:
+        registros = []
+        for campos, foto_nome, foto_bytes, foto_imagem in itens:
+            try:
+                registros.append(_montar_registro(RegistroAcessoFacial, campos, foto_nome, foto_bytes, foto_imagem))
+            except Exception:
+                logger.exception("Erro ao preparar registro de acesso facial; registro descartado")
+        if not registros:
+            return
+
+        try:
+            RegistroAcessoFacial.registrar_em_lote(registros)
+            return
+        except Exception:
+            logger.exception(
+                "Erro ao gravar lote de %d registro(s) de acesso facial; gravando individualmente",
+                len(registros)
+            )
+
+        for registro in registros:
+            registro.pk = None
+            registro._state.adding = True
+            try:
+                registro.save()
+            except Exception:
+                logger.exception("Erro ao gravar registro de acesso facial; registro descartado")
+                # Sem a linha no banco, a foto biométrica não pode ficar órfã no storage
+                if registro.foto_capturada:
+                    registro.foto_capturada.delete(save=False)
+    finally:
+        if threading.current_thread() is _worker:
+            close_old_connections()
+
+
+def _montar_registro(modelo, campos, foto_nome, foto_bytes, foto_imagem):
+    """Cria o registro em memória e grava a foto no storage, codificando-a em WebP se necessário."""
+    registro = modelo(**campos)
+    if foto_bytes is None and foto_imagem is not None and CV2_AVAILABLE:
+        ok, buffer = cv2.imencode('.webp', foto_imagem, [int(cv2.IMWRITE_WEBP_QUALITY), AUDIT_WEBP_QUALITY])
+        if ok:
+            foto_bytes = buffer.tobytes()
+    if foto_bytes is not None:
+        registro.foto_capturada.save(foto_nome, ContentFile(foto_bytes), save=False)
+    return registro
+
+
+@atexit.register
+def _descarregar_fila():
+    """Grava o que ainda estiver na fila e espera o lote em andamento quando o processo é encerrado."""
+    itens = []
+    while True:
+        try:
+            itens.append(_AUDIT_QUEUE.get_nowait())
+        except queue.Empty:
+            break
+    if itens:
+        try:
+            _gravar_lote(itens)
+        finally:
+            for _ in itens:
+                _AUDIT_QUEUE.task_done()
+
+    # O worker é daemon: sem esperar, o lote que ele já retirou da fila se perderia
+    if _worker is not None and _worker.is_alive():
+        espera = threading.Thread(target=_AUDIT_QUEUE.join, daemon=True)
+        espera.start()
+        espera.join(AUDIT_EXIT_TIMEOUT)
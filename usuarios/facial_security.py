@@ -1,6 +1,15 @@
 import base64
+import io
+import multiprocessing
+import os
 import pickle
+import threading
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
 from cryptography.fernet import Fernet
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
 from django.conf import settings
 from django.core.cache import cache
 from django.utils import timezone
@@ -12,12 +21,91 @@ try:
     import numpy as np
     import cv2
     import face_recognition
+    import dlib
     FACIAL_LIBS_AVAILABLE = True
 except ImportError:
     FACIAL_LIBS_AVAILABLE = False
 
+# Índice aproximado (opcional) para pré-filtrar candidatos em bases grandes
+try:
+    import faiss
+    FAISS_AVAILABLE = True
+except ImportError:
+    FAISS_AVAILABLE = False
+
+# O dlib executa o detector CNN e a rede de encoding na GPU quando compilado com CUDA
+FACIAL_GPU_AVAILABLE = FACIAL_LIBS_AVAILABLE and bool(getattr(dlib, 'DLIB_USE_CUDA', False))
+
 logger = logging.getLogger(__name__)
 
+# Encodings são vetores de 128 posições, armazenados como float32 (512 bytes) antes de criptografar
+ENCODING_DIMENSION = 128
+ENCODING_BYTES = ENCODING_DIMENSION * 4
+
+# Formato atual dos encodings criptografados: versão (1 byte) + nonce (12 bytes) + AES-GCM.
+# Tokens Fernet legados começam com b'g' e continuam sendo aceitos na leitura.
+ENCRYPTION_VERSION_AESGCM = b'\x01'
+AESGCM_NONCE_BYTES = 12
+
+# Candidatos recuperados do índice aproximado antes da comparação exata
+ANN_CANDIDATOS = 8
+
+# Índice faiss da matriz de encodings atual, mantido em memória pelo processo junto
+# com a versão e os ids dos usuários na ordem das linhas usadas para construí-lo
+_indices_ann = {}
+
+# Encodings já descriptografados, por (usuário, versão do encoding), em ordem de uso
+# (LRU). Cada cadastro gera uma nova versão; as entradas de encodings removidos ou
+# substituídos são descartadas quando a matriz é refeita ou o cache é invalidado
+ENCODINGS_DECIFRADOS_MAX = 4096
+_encodings_decifrados = OrderedDict()
+_encodings_decifrados_lock = threading.Lock()
+
+
+def _iniciar_processo_pool():
+    """Prepara o Django nos processos do pool, iniciados do zero (spawn)."""
+    import django
+    django.setup()
+
+
+def _extrair_encoding_foto(conteudo):
+    """Extrai o encoding facial dos bytes de uma foto (executado nos processos do pool)."""
+    try:
+        image = facial_manager.carregar_imagem(conteudo)
+        face_encoding, error_msg = facial_manager.analisar_face(image)
+        return face_encoding
+    except Exception as e:
+        logger.error(f"Erro ao extrair encoding da foto: {e}")
+        return None
+
+
+def _decrypt_encoding_cached(user_id, version, encrypted_encoding):
+    """Descriptografa o encoding de um usuário, memorizando o resultado por (usuário, versão)."""
+    chave = (user_id, version)
+    with _encodings_decifrados_lock:
+        encoding = _encodings_decifrados.get(chave)
+        if encoding is not None:
+            _encodings_decifrados.move_to_end(chave)
+            return encoding
+    
+    encoding = facial_manager.decrypt_encoding(encrypted_encoding)
+    if encoding is not None:
+        with _encodings_decifrados_lock:
+            _encodings_decifrados[chave] = encoding
+            while len(_encodings_decifrados) > ENCODINGS_DECIFRADOS_MAX:
+                _encodings_decifrados.popitem(last=False)
+    return encoding
+
+
+def limpar_encodings_decifrados(manter=None):
+    """Descarta os encodings descriptografados em memória, exceto as chaves (usuário, versão) em manter."""
+    with _encodings_decifrados_lock:
+        if not manter:
+            _encodings_decifrados.clear()
+            return
+        for chave in [chave for chave in _encodings_decifrados if chave not in manter]:
+            del _encodings_decifrados[chave]
+
 
 class FacialSecurityManager:
     """Gerenciador de segurança para reconhecimento facial."""
@@ -29,21 +117,33 @@ class FacialSecurityManager:
         self.confidence_threshold = getattr(settings, 'FACIAL_CONFIDENCE_THRESHOLD', 0.6)
         self.max_attempts = getattr(settings, 'FACIAL_MAX_ATTEMPTS', 3)
         self.attempt_timeout = getattr(settings, 'FACIAL_ATTEMPT_TIMEOUT', 300)
-        self._cipher = None
+        self.detection_model = getattr(settings, 'FACIAL_DETECTION_MODEL', None) or (
+            'cnn' if FACIAL_GPU_AVAILABLE else 'hog'
+        )
+        self.detect_max_side = getattr(settings, 'FACIAL_DETECT_MAXSIDE', 640)
+        self.ann_min_users = getattr(settings, 'FACIAL_ANN_MIN_USERS', 0)
+        self.liveness_min_sharpness = getattr(settings, 'FACIAL_LIVENESS_MIN_SHARPNESS', 100)
+        self.liveness_min_entropy = getattr(settings, 'FACIAL_LIVENESS_MIN_ENTROPY', 4.5)
+        key = self._obter_chave()
+        # Fernet é mantido apenas para ler encodings gravados no formato antigo
+        self.cipher = Fernet(key)
+        self.aead = AESGCM(HKDF(
+            algorithm=hashes.SHA256(),
+            length=32,
+            salt=None,
+            info=b'usuarios.face_encoding.aesgcm',
+        ).derive(base64.urlsafe_b64decode(key)))
     
-    @property
-    def cipher(self):
-        """Obtém ou cria a chave de criptografia."""
-        if not self._cipher:
-            # Em produção, esta chave deve ser armazenada de forma segura
-            key = getattr(settings, 'FACIAL_ENCRYPTION_KEY', None)
-            if not key:
-                # Gera uma chave baseada no SECRET_KEY do Django
-                key = base64.urlsafe_b64encode(settings.SECRET_KEY[:32].encode().ljust(32))[:44]
-            else:
-                key = key.encode() if isinstance(key, str) else key
-            self._cipher = Fernet(key)
-        return self._cipher
+    def _obter_chave(self):
+        """Obtém a chave de criptografia (formato Fernet, base64 de 32 bytes)."""
+        # Em produção, esta chave deve ser armazenada de forma segura
+        key = getattr(settings, 'FACIAL_ENCRYPTION_KEY', None)
+        if not key:
+            # Gera uma chave baseada no SECRET_KEY do Django
+            key = base64.urlsafe_b64encode(settings.SECRET_KEY[:32].encode().ljust(32))[:44]
+        else:
+            key = key.encode() if isinstance(key, str) else key
+        return key
     
     def encrypt_encoding(self, face_encoding):
         """Criptografa o encoding facial para armazenamento."""
@@ -51,11 +151,12 @@ class FacialSecurityManager:
             return None
         
         try:
-            # Serializa o numpy array
-            encoded_data = pickle.dumps(face_encoding)
-            # Criptografa
-            encrypted = self.cipher.encrypt(encoded_data)
-            return encrypted
+            # Serializa o numpy array como bytes float32 brutos
+            encoded_data = np.asarray(face_encoding, dtype=np.float32).tobytes()
+            # Criptografa com AES-GCM; o byte de versão também é autenticado
+            nonce = os.urandom(AESGCM_NONCE_BYTES)
+            encrypted = self.aead.encrypt(nonce, encoded_data, ENCRYPTION_VERSION_AESGCM)
+            return ENCRYPTION_VERSION_AESGCM + nonce + encrypted
         except Exception as e:
             logger.error(f"Erro ao criptografar encoding: {e}")
             return None
@@ -66,31 +167,63 @@ class FacialSecurityManager:
             return None
         
         try:
-            # Descriptografa
-            decrypted = self.cipher.decrypt(bytes(encrypted_encoding))
-            # Deserializa
-            face_encoding = pickle.loads(decrypted)
-            return face_encoding
+            # Descriptografa conforme o formato indicado pelo primeiro byte
+            encrypted_encoding = bytes(encrypted_encoding)
+            if encrypted_encoding[:1] == ENCRYPTION_VERSION_AESGCM:
+                nonce = encrypted_encoding[1:1 + AESGCM_NONCE_BYTES]
+                decrypted = self.aead.decrypt(
+                    nonce, encrypted_encoding[1 + AESGCM_NONCE_BYTES:], ENCRYPTION_VERSION_AESGCM
+                )
+            else:
+                decrypted = self.cipher.decrypt(encrypted_encoding)
+            # Deserializa sem cópia; registros antigos foram gravados com pickle
+            if len(decrypted) == ENCODING_BYTES:
+                return np.frombuffer(decrypted, dtype=np.float32)
+            return pickle.loads(decrypted)
         except Exception as e:
             logger.error(f"Erro ao descriptografar encoding: {e}")
             return None
     
-    def extract_face_encoding(self, image):
-        """Extrai o encoding facial de uma imagem."""
+    def _converter_rgb(self, image):
+        """Converte uma imagem OpenCV (cinza, BGR ou BGRA) para RGB."""
+        if len(image.shape) == 2:
+            return cv2.cvtColor(image, cv2.COLOR_GRAY2RGB)
+        if image.shape[2] == 4:
+            return cv2.cvtColor(image, cv2.COLOR_BGRA2RGB)
+        return cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+    
+    def reduzir_imagem(self, image, max_side):
+        """Reduz a imagem para que o maior lado não passe de max_side (0 mantém o tamanho)."""
+        h, w = image.shape[:2]
+        if not max_side or max(h, w) <= max_side:
+            return image
+        scale = max_side / max(h, w)
+        return cv2.resize(
+            image, (max(1, int(w * scale)), max(1, int(h * scale))),
+            interpolation=cv2.INTER_AREA
+        )
+    
+    def _preparar_imagem(self, image):
+        """Converte a imagem uma única vez: RGB para o encoding e cinza para o liveness."""
+        if not FACIAL_LIBS_AVAILABLE:
+            return None, None
+        
+        rgb_image = self._converter_rgb(image)
+        gray = cv2.cvtColor(rgb_image, cv2.COLOR_RGB2GRAY)
+        return rgb_image, gray
+    
+    def extract_face_encoding(self, image, rgb_image=None):
+        """Extrai o encoding facial de uma imagem (ou da versão RGB já convertida)."""
         if not FACIAL_LIBS_AVAILABLE:
             return None, "Bibliotecas de reconhecimento facial não disponíveis"
             
         try:
             # Converte para RGB se necessário
-            if len(image.shape) == 2:
-                rgb_image = cv2.cvtColor(image, cv2.COLOR_GRAY2RGB)
-            elif image.shape[2] == 4:
-                rgb_image = cv2.cvtColor(image, cv2.COLOR_BGRA2RGB)
-            else:
-                rgb_image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+            if rgb_image is None:
+                rgb_image = self._converter_rgb(image)
             
-            # Detecta faces na imagem
-            face_locations = face_recognition.face_locations(rgb_image)
+            # Detecta faces em uma cópia reduzida e reprojeta as caixas na imagem original
+            face_locations = self._detectar_faces(rgb_image)
             
             if not face_locations:
                 return None, "Nenhuma face detectada na imagem"
@@ -110,6 +243,24 @@ class FacialSecurityManager:
             logger.error(f"Erro ao extrair face encoding: {e}")
             return None, str(e)
     
+    def _detectar_faces(self, rgb_image):
+        """Executa o detector com o maior lado limitado a FACIAL_DETECT_MAXSIDE."""
+        small = self.reduzir_imagem(rgb_image, self.detect_max_side)
+        if small is rgb_image:
+            return face_recognition.face_locations(rgb_image, model=self.detection_model)
+        
+        h, w = rgb_image.shape[:2]
+        scale = max(small.shape[:2]) / max(h, w)
+        return [
+            (
+                max(0, int(top / scale)),
+                min(w, int(right / scale)),
+                min(h, int(bottom / scale)),
+                max(0, int(left / scale)),
+            )
+            for top, right, bottom, left in face_recognition.face_locations(small, model=self.detection_model)
+        ]
+    
     def compare_faces(self, known_encoding, unknown_encoding, tolerance=None):
         """Compara dois encodings faciais."""
         if not FACIAL_LIBS_AVAILABLE:
@@ -119,14 +270,18 @@ class FacialSecurityManager:
             tolerance = 1 - self.confidence_threshold
         
         try:
-            # Calcula a distância entre os encodings
-            distance = face_recognition.face_distance([known_encoding], unknown_encoding)[0]
+            # Distância euclidiana ao quadrado em float32 entre os encodings
+            diff = (
+                np.ascontiguousarray(known_encoding, dtype=np.float32)
+                - np.ascontiguousarray(unknown_encoding, dtype=np.float32)
+            )
+            squared_distance = float(np.dot(diff, diff))
             
-            # Converte distância em confiança percentual
-            confidence = (1 - distance) * 100
+            # Verifica se é um match sem precisar da raiz quadrada
+            is_match = squared_distance <= tolerance ** 2
             
-            # Verifica se é um match
-            is_match = distance <= tolerance
+            # Converte distância em confiança percentual
+            confidence = (1 - squared_distance ** 0.5) * 100
             
             return is_match, confidence
             
@@ -134,20 +289,24 @@ class FacialSecurityManager:
             logger.error(f"Erro ao comparar faces: {e}")
             return False, 0
     
-    def validate_liveness(self, image):
+    def validate_liveness(self, image, gray=None):
         """Validação básica anti-spoofing (detecção de foto vs pessoa real)."""
         if not FACIAL_LIBS_AVAILABLE:
             return True, "Validação de liveness não disponível"
             
         try:
-            # Converte para escala de cinza
-            gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+            if gray is None:
+                # Converte para escala de cinza (na resolução original: a nitidez
+                # medida pelo Laplaciano não se mantém em uma imagem reduzida)
+                gray = image if image.ndim == 2 else cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
             
-            # Calcula o Laplaciano (detecta blur/foco)
-            laplacian_var = cv2.Laplacian(gray, cv2.CV_64F).var()
+            # Calcula a variância do Laplaciano (detecta blur/foco); com o kernel
+            # padrão o resultado é inteiro e cabe em CV_16S, sem alterar o limiar
+            _, std = cv2.meanStdDev(cv2.Laplacian(gray, cv2.CV_16S))
+            laplacian_var = float(std[0, 0]) ** 2
             
             # Se a imagem está muito desfocada, pode ser uma foto de foto
-            if laplacian_var < 100:
+            if laplacian_var < self.liveness_min_sharpness:
                 return False, "Imagem muito desfocada. Por favor, ajuste o foco da câmera"
             
             # Análise de histograma para detectar impressões
@@ -155,9 +314,10 @@ class FacialSecurityManager:
             hist_normalized = hist.ravel() / hist.sum()
             
             # Calcula entropia (imagens impressas tendem a ter menor entropia)
-            entropy = -sum([p * np.log2(p + 1e-7) for p in hist_normalized if p > 0])
+            probabilidades = hist_normalized[hist_normalized > 0]
+            entropy = float(-np.dot(probabilidades, np.log2(probabilidades)))
             
-            if entropy < 4.5:
+            if entropy < self.liveness_min_entropy:
                 return False, "Possível tentativa de spoofing detectada"
             
             return True, "Validação de liveness aprovada"
@@ -166,6 +326,81 @@ class FacialSecurityManager:
             logger.error(f"Erro na validação de liveness: {e}")
             return True, "Validação de liveness não disponível"
     
+    def _carregar_matriz(self):
+        """Retorna a versão da matriz de encodings junto com (ids, versões dos encodings, matriz, normas).
+        
+        A matriz é montada uma única vez por versão e mantida no cache do Django;
+        Usuario.invalidar_cache_encodings() publica uma nova versão quando algum encoding muda.
+        """
+        from .models import Usuario, FACIAL_ENCODINGS_VERSION_KEY
+        
+        version = cache.get_or_set(FACIAL_ENCODINGS_VERSION_KEY, 0, None)
+        cache_key = f"facial_encoding_matrix_v2_{version}"
+        cached = cache.get(cache_key)
+        if cached is not None:
+            return (version,) + cached
+        
+        ids = []
+        versoes = []
+        encodings = []
+        usuarios_com_facial = Usuario.objects.filter(
+            reconhecimento_facial_ativo=True,
+            face_encoding__isnull=False,
+            ativo=True,
+            permite_reconhecimento_facial=True
+        ).order_by().values_list('id', 'face_encoding_version', 'face_encoding')
+        
+        for user_id, enc_version, encrypted_encoding in usuarios_com_facial:
+            stored_encoding = _decrypt_encoding_cached(user_id, enc_version, bytes(encrypted_encoding))
+            if stored_encoding is None:
+                continue
+            ids.append(user_id)
+            versoes.append(enc_version)
+            encodings.append(np.asarray(stored_encoding, dtype=np.float32))
+        
+        ids = np.array(ids, dtype=np.int64)
+        versoes = np.array(versoes, dtype=np.int64)
+        matrix = np.stack(encodings) if encodings else np.empty((0, ENCODING_DIMENSION), dtype=np.float32)
+        normas = np.einsum('ij,ij->i', matrix, matrix)
+        cache.set(cache_key, (ids, versoes, matrix, normas))
+        
+        # A matriz nova vale também para os outros processos: encodings que saíram dela
+        # (removidos, desativados ou substituídos) não ficam descriptografados em memória
+        limpar_encodings_decifrados(manter=set(zip(ids.tolist(), versoes.tolist())))
+        return version, ids, versoes, matrix, normas
+    
+    def _get_indice_ann(self, version, ids, matrix):
+        """Retorna o índice HNSW do faiss para a matriz, construindo-o se necessário."""
+        # As posições do índice só valem para a mesma sequência de usuários: além da
+        # versão, confere os ids para nunca usar um índice de outra matriz
+        atual = _indices_ann.get('atual')
+        if atual is not None and atual[0] == version and np.array_equal(atual[1], ids):
+            return atual[2]
+        
+        indice = faiss.IndexHNSWFlat(ENCODING_DIMENSION, 32)
+        indice.add(matrix)
+        # Só a matriz atual é útil; substitui o índice anterior
+        _indices_ann['atual'] = (version, ids.copy(), indice)
+        return indice
+    
+    def _buscar_mais_proximo(self, version, ids, matrix, normas, probe):
+        """Retorna (posição, distância ao quadrado) do encoding mais próximo do probe."""
+        if FAISS_AVAILABLE and self.ann_min_users and len(matrix) > self.ann_min_users:
+            # O índice HNSW guarda os vetores completos, então as distâncias
+            # retornadas para os candidatos já são as distâncias L2 exatas
+            distancias, posicoes = self._get_indice_ann(version, ids, matrix).search(
+                probe[np.newaxis, :], ANN_CANDIDATOS
+            )
+            validos = posicoes[0] >= 0
+            if validos.any():
+                melhor = int(distancias[0][validos].argmin())
+                return int(posicoes[0][validos][melhor]), float(distancias[0][validos][melhor])
+        
+        # ||m - p||² = ||m||² - 2 m·p + ||p||²: um único produto matriz-vetor sobre a matriz
+        distancias = normas - 2 * (matrix @ probe)
+        idx = int(distancias.argmin())
+        return idx, max(float(distancias[idx] + np.dot(probe, probe)), 0.0)
+    
     def check_attempt_limit(self, user_id):
         """Verifica se o usuário excedeu o limite de tentativas."""
         cache_key = f"facial_attempts_{user_id}"
@@ -192,8 +427,11 @@ class FacialSecurityManager:
         """Processa tentativa de login facial."""
         from .models import Usuario, RegistroAcessoFacial
         
+        # Converte a imagem uma única vez para o liveness e a extração
+        rgb_image, gray = self._preparar_imagem(image)
+        
         # Valida liveness
-        is_live, liveness_msg = self.validate_liveness(image)
+        is_live, liveness_msg = self.validate_liveness(image, gray=gray)
         if not is_live:
             return {
                 'success': False,
@@ -202,7 +440,7 @@ class FacialSecurityManager:
             }
         
         # Extrai encoding da imagem
-        face_encoding, error_msg = self.extract_face_encoding(image)
+        face_encoding, error_msg = self.extract_face_encoding(image, rgb_image=rgb_image)
         if face_encoding is None:
             return {
                 'success': False,
@@ -220,7 +458,9 @@ class FacialSecurityManager:
                 }
             
             # Descriptografa o encoding armazenado
-            stored_encoding = self.decrypt_encoding(user.face_encoding)
+            stored_encoding = _decrypt_encoding_cached(
+                user.pk, user.face_encoding_version, bytes(user.face_encoding)
+            )
             if stored_encoding is None:
                 return {
                     'success': False,
@@ -250,25 +490,39 @@ class FacialSecurityManager:
                     'confidence': confidence
                 }
         
-        # Busca entre todos os usuários com reconhecimento facial ativo
-        usuarios_com_facial = Usuario.objects.filter(
-            reconhecimento_facial_ativo=True,
-            face_encoding__isnull=False
-        )
-        
+        # Compara com todos os usuários com reconhecimento facial ativo em uma única operação vetorizada
         melhor_match = None
         melhor_confianca = 0
+        tolerance = 1 - self.confidence_threshold
+        probe = np.asarray(face_encoding, dtype=np.float32)
         
-        for usuario in usuarios_com_facial:
-            stored_encoding = self.decrypt_encoding(usuario.face_encoding)
-            if stored_encoding is None:
-                continue
+        # Uma segunda passada só acontece quando a matriz em cache estava desatualizada
+        for _ in range(2):
+            version, ids, versoes, matrix, normas = self._carregar_matriz()
+            if not len(ids):
+                break
             
-            is_match, confidence = self.compare_faces(stored_encoding, face_encoding)
+            idx, distancia = self._buscar_mais_proximo(version, ids, matrix, normas, probe)
             
-            if is_match and confidence > melhor_confianca:
-                melhor_match = usuario
-                melhor_confianca = confidence
+            # Distâncias ao quadrado: compara com a tolerância ao quadrado para evitar sqrt por usuário
+            if distancia > tolerance ** 2:
+                break
+            
+            # Confirma no banco antes de autenticar: com cache por processo, outro worker
+            # pode ter trocado ou revogado o encoding depois que esta matriz foi montada
+            melhor_match = Usuario.objects.filter(
+                pk=int(ids[idx]),
+                face_encoding_version=int(versoes[idx]),
+                reconhecimento_facial_ativo=True,
+                ativo=True,
+                permite_reconhecimento_facial=True
+            ).first()
+            if melhor_match is not None:
+                melhor_confianca = (1 - distancia ** 0.5) * 100
+                break
+            
+            # A matriz referencia um encoding substituído ou um usuário removido/desativado
+            Usuario.invalidar_cache_encodings()
         
         if melhor_match:
             melhor_match.resetar_tentativas_facial()
@@ -287,17 +541,26 @@ class FacialSecurityManager:
             'confidence': 0
         }
     
-    def register_face(self, user, image):
-        """Registra a face de um usuário."""
-        # Valida liveness
-        is_live, liveness_msg = self.validate_liveness(image)
+    def analisar_face(self, image):
+        """Valida o liveness e extrai o encoding facial de uma imagem."""
+        rgb_image, gray = self._preparar_imagem(image)
+        
+        is_live, liveness_msg = self.validate_liveness(image, gray=gray)
         if not is_live:
-            return False, liveness_msg
+            return None, liveness_msg
         
-        # Extrai encoding
-        face_encoding, error_msg = self.extract_face_encoding(image)
+        face_encoding, error_msg = self.extract_face_encoding(image, rgb_image=rgb_image)
+        if face_encoding is None:
+            return None, error_msg or "Não foi possível processar a face"
+        
+        return face_encoding, None
+    
+    def register_face(self, user, image):
+        """Registra a face de um usuário."""
+        # Valida liveness e extrai encoding
+        face_encoding, error_msg = self.analisar_face(image)
         if face_encoding is None:
-            return False, error_msg or "Não foi possível processar a face"
+            return False, error_msg
         
         # Criptografa e salva
         encrypted = self.encrypt_encoding(face_encoding)
@@ -305,32 +568,37 @@ class FacialSecurityManager:
             return False, "Erro ao processar dados faciais"
         
         user.face_encoding = encrypted
+        user.face_encoding_version += 1
         user.reconhecimento_facial_ativo = True
         user.data_cadastro_facial = timezone.now()
-        user.save(update_fields=['face_encoding', 'reconhecimento_facial_ativo', 'data_cadastro_facial'])
+        user.save(update_fields=['face_encoding', 'face_encoding_version', 'reconhecimento_facial_ativo', 'data_cadastro_facial'])
         
         return True, "Face cadastrada com sucesso"
     
+    def carregar_imagem(self, arquivo):
+        """Converte uma foto (arquivo ou bytes) em array OpenCV no formato BGR."""
+        from PIL import Image as PILImage
+        
+        if isinstance(arquivo, bytes):
+            arquivo = io.BytesIO(arquivo)
+        
+        pil_image = PILImage.open(arquivo)
+        
+        # Converte PIL para array numpy/OpenCV
+        if pil_image.mode != 'RGB':
+            pil_image = pil_image.convert('RGB')
+        
+        return cv2.cvtColor(np.array(pil_image), cv2.COLOR_RGB2BGR)
+    
     def processar_nova_foto_usuario(self, usuario):
         """Processa nova foto de perfil facial de um usuário."""
         if not usuario.foto_perfil_facial:
             return False
             
         try:
-            # Abre a imagem da foto de perfil
-            from PIL import Image as PILImage
-            import io
-            
             # Abre a imagem do campo ImageField
             with usuario.foto_perfil_facial.open('rb') as foto_file:
-                pil_image = PILImage.open(foto_file)
-                
-                # Converte PIL para array numpy/OpenCV
-                if pil_image.mode != 'RGB':
-                    pil_image = pil_image.convert('RGB')
-                
-                import numpy as np
-                cv_image = cv2.cvtColor(np.array(pil_image), cv2.COLOR_RGB2BGR)
+                cv_image = self.carregar_imagem(foto_file)
                 
                 # Usa o método register_face existente
                 success, message = self.register_face(usuario, cv_image)
@@ -339,4 +607,62 @@ class FacialSecurityManager:
                 
         except Exception as e:
             logger.error(f"Erro ao processar foto do usuário {usuario.username}: {e}")
-            return False
\ No newline at end of file
+            return False
+    
+    def processar_fotos_em_lote(self, usuarios):
+        """Extrai em paralelo os encodings das fotos de vários usuários e salva em lote.
+        
+        Retorna uma tupla (processados, falhas).
+        """
+        from .models import Usuario
+        
+        usuarios = list(usuarios)
+        conteudos = {}
+        for usuario in usuarios:
+            try:
+                with usuario.foto_perfil_facial.open('rb') as foto_file:
+                    conteudos[usuario.pk] = foto_file.read()
+            except Exception as e:
+                logger.error(f"Erro ao ler foto do usuário {usuario.username}: {e}")
+        
+        encodings = {}
+        if conteudos:
+            # A extração é CPU-bound: distribui as fotos entre os núcleos disponíveis.
+            # Os processos são iniciados com spawn: um fork no meio da requisição
+            # herdaria threads (auditoria), conexões e o contexto CUDA do dlib
+            max_workers = min(os.cpu_count() or 1, len(conteudos))
+            with ProcessPoolExecutor(
+                max_workers=max_workers,
+                mp_context=multiprocessing.get_context('spawn'),
+                initializer=_iniciar_processo_pool,
+            ) as executor:
+                encodings = dict(zip(conteudos, executor.map(_extrair_encoding_foto, conteudos.values())))
+        
+        agora = timezone.now()
+        atualizados = []
+        for usuario in usuarios:
+            face_encoding = encodings.get(usuario.pk)
+            encrypted = self.encrypt_encoding(face_encoding) if face_encoding is not None else None
+            if encrypted is None:
+                continue
+            
+            usuario.face_encoding = encrypted
+            usuario.face_encoding_version += 1
+            usuario.reconhecimento_facial_ativo = True
+            usuario.data_cadastro_facial = agora
+            atualizados.append(usuario)
+        
+        Usuario.objects.bulk_update(
+            atualizados,
+            ['face_encoding', 'face_encoding_version', 'reconhecimento_facial_ativo', 'data_cadastro_facial'],
+            batch_size=500
+        )
+        if atualizados:
+            Usuario.invalidar_cache_encodings()
+        
+        return len(atualizados), len(usuarios) - len(atualizados)
+
+
+# Instância compartilhada pelo processo. Não guarda estado por requisição e o
+# Fernet é thread-safe, então pode ser usada simultaneamente por várias threads.
+facial_manager = FacialSecurityManager()
@@ -0,0 +1,49 @@
+# Generated by Django 4.2.7 on 2026-10-14 13:00
+
+from django.db import migrations, models
+
+
+def preencher_cache_hierarquia(apps, schema_editor):
+    """Calcula o caminho e o nível dos grupos já existentes."""
+    Grupo = apps.get_model('usuarios', 'Grupo')
+    grupos = {grupo.pk: grupo for grupo in Grupo.objects.all()}
+    calculados = set()
+
+    def calcular(grupo, visitados):
+        if grupo.pk in calculados:
+            return
+        pai = grupos.get(grupo.grupo_pai_id)
+        if pai and pai.pk not in visitados:
+            calcular(pai, visitados | {grupo.pk})
+            grupo.hierarquia_cache = f"{pai.hierarquia_cache} > {grupo.nome}"
+            grupo.nivel_cache = pai.nivel_cache + 1
+        else:
+            grupo.hierarquia_cache = grupo.nome
+            grupo.nivel_cache = 0
+        calculados.add(grupo.pk)
+
+    for grupo in grupos.values():
+        calcular(grupo, {grupo.pk})
+
+    Grupo.objects.bulk_update(grupos.values(), ['hierarquia_cache', 'nivel_cache'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('usuarios', '0003_alter_usuario_foto_perfil_facial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='grupo',
+            name='hierarquia_cache',
+            field=models.CharField(blank=True, editable=False, help_text='Caminho completo da hierarquia, recalculado ao salvar o grupo', max_length=500, verbose_name='Hierarquia'),
+        ),
+        migrations.AddField(
+            model_name='grupo',
+            name='nivel_cache',
+            field=models.PositiveSmallIntegerField(default=0, editable=False, help_text='Nível na hierarquia (0 para grupos raiz), recalculado ao salvar o grupo', verbose_name='Nível'),
+        ),
+        migrations.RunPython(preencher_cache_hierarquia, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,21 @@
+# Generated by Django 4.2.7 on 2026-10-14 13:04
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('usuarios', '0004_grupo_hierarquia_cache'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='usuario',
+            index=models.Index(fields=['ativo', 'grupo_primario'], name='usuarios_us_ativo_04cddb_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='usuario',
+            index=models.Index(fields=['reconhecimento_facial_ativo'], name='usuarios_us_reconhe_586eef_idx'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.2.7 on 2026-10-14 13:07
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('usuarios', '0005_usuario_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='usuario',
+            name='face_encoding_version',
+            field=models.PositiveIntegerField(default=0, editable=False, help_text='Incrementada a cada novo encoding; invalida os caches de encodings descriptografados', verbose_name='Versão do Encoding Facial'),
+        ),
+    ]
@@ -0,0 +1,42 @@
+# Generated by Django 4.2.7 on 2026-10-14 13:10
+
+from django.db import migrations, models
+
+
+def preencher_caminho_cache(apps, schema_editor):
+    """Calcula o caminho de IDs dos grupos já existentes."""
+    Grupo = apps.get_model('usuarios', 'Grupo')
+    grupos = {grupo.pk: grupo for grupo in Grupo.objects.all()}
+    calculados = set()
+
+    def calcular(grupo, visitados):
+        if grupo.pk in calculados:
+            return
+        pai = grupos.get(grupo.grupo_pai_id)
+        if pai and pai.pk not in visitados:
+            calcular(pai, visitados | {grupo.pk})
+            grupo.caminho_cache = f"{pai.caminho_cache}{grupo.pk}/"
+        else:
+            grupo.caminho_cache = f"{grupo.pk}/"
+        calculados.add(grupo.pk)
+
+    for grupo in grupos.values():
+        calcular(grupo, {grupo.pk})
+
+    Grupo.objects.bulk_update(grupos.values(), ['caminho_cache'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('usuarios', '0006_usuario_face_encoding_version'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='grupo',
+            name='caminho_cache',
+            field=models.CharField(blank=True, db_index=True, editable=False, help_text='IDs da raiz até o grupo (ex.: "1/4/17/"), recalculado ao salvar o grupo', max_length=255, verbose_name='Caminho'),
+        ),
+        migrations.RunPython(preencher_caminho_cache, migrations.RunPython.noop),
+    ]
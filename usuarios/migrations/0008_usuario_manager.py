@@ -0,0 +1,20 @@
+# Generated by Django 4.2.7 on 2026-10-14 13:10
+
+from django.db import migrations
+import usuarios.models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('usuarios', '0007_grupo_caminho_cache'),
+    ]
+
+    operations = [
+        migrations.AlterModelManagers(
+            name='usuario',
+            managers=[
+                ('objects', usuarios.models.UsuarioManager()),
+            ],
+        ),
+    ]
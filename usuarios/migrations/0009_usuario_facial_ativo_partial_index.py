@@ -0,0 +1,21 @@
+# Generated by Django 4.2.7 on 2026-10-14 13:18
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('usuarios', '0008_usuario_manager'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='usuario',
+            name='usuarios_us_reconhe_586eef_idx',
+        ),
+        migrations.AddIndex(
+            model_name='usuario',
+            index=models.Index(condition=models.Q(('face_encoding__isnull', False), ('reconhecimento_facial_ativo', True)), fields=['id'], name='usuarios_facial_ativo_idx'),
+        ),
+    ]
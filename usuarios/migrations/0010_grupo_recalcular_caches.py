@@ -0,0 +1,41 @@
+# Generated by Django 4.2.7 on 2026-10-14 14:20
+
+from django.db import migrations
+
+
+def recalcular_caches_hierarquia(apps, schema_editor):
+    """Recalcula hierarquia, nível e caminho de todos os grupos, inclusive os carregados por fixture."""
+    Grupo = apps.get_model('usuarios', 'Grupo')
+    grupos = {grupo.pk: grupo for grupo in Grupo.objects.all()}
+    calculados = set()
+
+    def calcular(grupo, visitados):
+        if grupo.pk in calculados:
+            return
+        pai = grupos.get(grupo.grupo_pai_id)
+        if pai and pai.pk not in visitados:
+            calcular(pai, visitados | {grupo.pk})
+            grupo.hierarquia_cache = f"{pai.hierarquia_cache} > {grupo.nome}"
+            grupo.nivel_cache = pai.nivel_cache + 1
+            grupo.caminho_cache = f"{pai.caminho_cache}{grupo.pk}/"
+        else:
+            grupo.hierarquia_cache = grupo.nome
+            grupo.nivel_cache = 0
+            grupo.caminho_cache = f"{grupo.pk}/"
+        calculados.add(grupo.pk)
+
+    for grupo in grupos.values():
+        calcular(grupo, {grupo.pk})
+
+    Grupo.objects.bulk_update(grupos.values(), ['hierarquia_cache', 'nivel_cache', 'caminho_cache'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('usuarios', '0009_usuario_facial_ativo_partial_index'),
+    ]
+
+    operations = [
+        migrations.RunPython(recalcular_caches_hierarquia, migrations.RunPython.noop),
+    ]
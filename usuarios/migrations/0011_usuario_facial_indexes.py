@@ -0,0 +1,25 @@
+# Generated by Django 4.2.7 on 2026-10-14 13:50
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('usuarios', '0010_grupo_recalcular_caches'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='usuario',
+            name='usuarios_facial_ativo_idx',
+        ),
+        migrations.AddIndex(
+            model_name='usuario',
+            index=models.Index(fields=['reconhecimento_facial_ativo'], name='usuarios_us_reconhe_586eef_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='usuario',
+            index=models.Index(condition=models.Q(('ativo', True), ('face_encoding__isnull', False), ('permite_reconhecimento_facial', True), ('reconhecimento_facial_ativo', True)), fields=['id'], name='usuarios_facial_ativo_idx'),
+        ),
+    ]
@@ -1,47 +1,135 @@
 from django.db import models
+from django.db.models import Case, Count, F, OuterRef, Subquery, Value, When
+from django.db.models.functions import Coalesce
 from django.core.exceptions import ValidationError
-from django.contrib.auth.models import AbstractUser
+from django.contrib.auth.models import AbstractUser, UserManager
 from django.utils import timezone
-from django.core.files.uploadedfile import InMemoryUploadedFile
+from django.utils.functional import cached_property
+from django.core.cache import cache
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from django.core.files import File
 from PIL import Image
 import io
+import logging
+import struct
 
+logger = logging.getLogger(__name__)
 
-def validate_facial_image(image):
-    """Valida se a imagem é adequada para reconhecimento facial."""
+
+# Assinaturas (magic bytes) dos formatos aceitos para a foto facial
+ASSINATURAS_IMAGEM_FACIAL = (b'\xff\xd8\xff', b'\x89PNG\r\n\x1a\n')
+TAMANHO_MAXIMO_IMAGEM_FACIAL = 5 * 1024 * 1024  # 5MB
+DIMENSAO_MINIMA_IMAGEM_FACIAL = 100
+DIMENSAO_MAXIMA_IMAGEM_FACIAL = 2000
+
+# Marcadores JPEG de início de quadro (SOF), que trazem as dimensões; C4, C8 e CC não são SOF
+_MARCADORES_SOF_JPEG = frozenset(range(0xC0, 0xD0)) - {0xC4, 0xC8, 0xCC}
+# Marcadores JPEG sem campo de tamanho (TEM e RSTn)
+_MARCADORES_SEM_TAMANHO_JPEG = frozenset([0x01, *range(0xD0, 0xD8)])
+
+
+def _ler_dimensoes_cabecalho(image):
+    """
+    Lê (largura, altura) do IHDR do PNG ou do SOF do JPEG, pulando os demais
+    segmentos sem decodificar a imagem. Retorna None se o cabeçalho for inválido.
+    """
+    try:
+        image.seek(0)
+        cabecalho = image.read(24)
+        if cabecalho.startswith(b'\x89PNG\r\n\x1a\n'):
+            if len(cabecalho) < 24 or cabecalho[12:16] != b'IHDR':
+                return None
+            return struct.unpack('>II', cabecalho[16:24])
+        
+        # JPEG: percorre os segmentos depois do SOI até o primeiro SOF
+        image.seek(2)
+        while True:
+            byte = image.read(1)
+            if byte != b'\xff':
+                return None
+            marcador = image.read(1)
+            while marcador == b'\xff':  # bytes de preenchimento entre segmentos
+                marcador = image.read(1)
+            if not marcador or marcador == b'\xda':  # fim do arquivo ou dados antes do SOF
+                return None
+            tipo = marcador[0]
+            if tipo in _MARCADORES_SEM_TAMANHO_JPEG:
+                continue
+            campo = image.read(2)
+            if len(campo) < 2:
+                return None
+            tamanho = struct.unpack('>H', campo)[0]
+            if tipo in _MARCADORES_SOF_JPEG:
+                dados = image.read(5)
+                if len(dados) < 5:
+                    return None
+                altura, largura = struct.unpack('>xHH', dados)
+                return largura, altura
+            if tamanho < 2:
+                return None
+            image.seek(tamanho - 2, 1)
+    finally:
+        image.seek(0)
+
+
+def verificar_arquivo_facial(image):
+    """
+    Checagem rápida de tamanho, formato (pelos primeiros bytes) e dimensões
+    (pelo cabeçalho PNG/JPEG), sem abrir a imagem. Retorna a mensagem de erro ou None.
+    """
+    # Os uploads já informam o tamanho
+    file_size = getattr(image, 'size', None)
+    if file_size is None:
+        image.seek(0, 2)  # Vai para o final do arquivo
+        file_size = image.tell()  # Obtém o tamanho
+    
+    if file_size > TAMANHO_MAXIMO_IMAGEM_FACIAL:
+        return 'A imagem deve ter no máximo 5MB.'
+    
+    image.seek(0)
+    assinatura = image.read(8)
+    image.seek(0)
+    if not assinatura.startswith(ASSINATURAS_IMAGEM_FACIAL):
+        return 'Formato de imagem não suportado. Use JPEG ou PNG.'
+    
+    dimensoes = _ler_dimensoes_cabecalho(image)
+    if dimensoes is None:
+        return 'Arquivo de imagem inválido.'
+    width, height = dimensoes
+    if width < DIMENSAO_MINIMA_IMAGEM_FACIAL or height < DIMENSAO_MINIMA_IMAGEM_FACIAL:
+        return 'A imagem deve ter pelo menos 100x100 pixels.'
+    if width > DIMENSAO_MAXIMA_IMAGEM_FACIAL or height > DIMENSAO_MAXIMA_IMAGEM_FACIAL:
+        return 'A imagem não pode ser maior que 2000x2000 pixels.'
+    return None
+
+
+def validate_facial_image(image, verificar_arquivo=True):
+    """
+    Valida se a imagem é adequada para reconhecimento facial.
+
+    Com verificar_arquivo=False a checagem de tamanho, formato e dimensões é pulada,
+    para quem já chamou verificar_arquivo_facial antes.
+    """
     if not image:
         return
     
     try:
-        # Abre a imagem
-        img = Image.open(image)
-        
-        # Verifica se é uma imagem
-        img.verify()
-        
-        # Reabrir a imagem para mais validações (verify() consome o arquivo)
-        image.seek(0)
-        img = Image.open(image)
-        
-        # Validações de dimensões
-        width, height = img.size
-        if width < 100 or height < 100:
-            raise ValidationError('A imagem deve ter pelo menos 100x100 pixels.')
+        # Tamanho, formato e dimensões são rejeitados antes de envolver o PIL
+        erro = verificar_arquivo_facial(image) if verificar_arquivo else None
+        if erro:
+            raise ValidationError(erro)
         
-        if width > 2000 or height > 2000:
-            raise ValidationError('A imagem não pode ser maior que 2000x2000 pixels.')
+        # Abre a imagem uma única vez (apenas com os decoders aceitos)
+        img = Image.open(image, formats=['JPEG', 'PNG'])
         
         # Validação de formato
         if img.format not in ['JPEG', 'JPG', 'PNG']:
             raise ValidationError('Formato de imagem não suportado. Use JPEG ou PNG.')
         
-        # Validação de tamanho do arquivo
-        image.seek(0, 2)  # Vai para o final do arquivo
-        file_size = image.tell()  # Obtém o tamanho
+        # Verifica a integridade por último; verify() invalida o objeto, que não é mais usado
+        img.verify()
         image.seek(0)  # Volta ao início
-        
-        if file_size > 5 * 1024 * 1024:  # 5MB
-            raise ValidationError('A imagem deve ter no máximo 5MB.')
             
     except Exception as e:
         if isinstance(e, ValidationError):
@@ -49,6 +137,56 @@ def validate_facial_image(image):
         raise ValidationError('Arquivo de imagem inválido.')
 
 
+# Chave de cache com a versão atual da matriz de encodings usada no login facial
+FACIAL_ENCODINGS_VERSION_KEY = 'facial_encodings_version'
+
+# Chaves de cache com as opções dos filtros de grupo do admin, apagadas sempre que um grupo muda
+ADMIN_GRUPOS_SECUNDARIOS_LOOKUPS_KEY = 'admin_grupos_secundarios_lookups'
+ADMIN_GRUPO_PAI_LOOKUPS_KEY = 'admin_grupo_pai_lookups'
+GRUPO_LOOKUPS_CACHE_KEYS = (ADMIN_GRUPOS_SECUNDARIOS_LOOKUPS_KEY, ADMIN_GRUPO_PAI_LOOKUPS_KEY)
+
+# Campos do usuário que alteram a matriz de encodings quando mudam
+CAMPOS_MATRIZ_FACIAL = (
+    'reconhecimento_facial_ativo', 'ativo', 'permite_reconhecimento_facial',
+    'face_encoding_version', 'face_encoding',
+)
+_NAO_CARREGADO = object()
+
+
+class GrupoQuerySet(models.QuerySet):
+    """Consultas de grupos baseadas no caminho materializado da hierarquia."""
+    
+    def descendentes_de(self, grupo):
+        """Retorna todos os subgrupos (diretos e indiretos) de um grupo em uma única consulta."""
+        if grupo.pk is None:
+            return self.none()
+        if not grupo.caminho_cache:
+            # Sem caminho materializado, desce a hierarquia nível a nível por grupo_pai
+            ids, nivel = set(), {grupo.pk}
+            while nivel:
+                nivel = set(Grupo.objects.filter(grupo_pai__in=nivel).values_list('pk', flat=True)) - ids - {grupo.pk}
+                ids |= nivel
+            return self.filter(pk__in=ids)
+        return self.filter(caminho_cache__startswith=grupo.caminho_cache).exclude(pk=grupo.pk)
+    
+    def com_contagens(self):
+        """Anota a quantidade de usuários primários e secundários de cada grupo.
+        
+        Usa subconsultas em vez de Count() sobre JOINs para não multiplicar as
+        linhas quando as duas relações são contadas juntas.
+        """
+        primarios = Usuario.objects.filter(grupo_primario=OuterRef('pk')).order_by().values(
+            'grupo_primario'
+        ).annotate(total=Count('pk')).values('total')
+        secundarios = Usuario.grupos_secundarios.through.objects.filter(grupo=OuterRef('pk')).order_by().values(
+            'grupo'
+        ).annotate(total=Count('pk')).values('total')
+        return self.annotate(
+            _usuarios_primarios_count=Coalesce(Subquery(primarios), 0),
+            _usuarios_secundarios_count=Coalesce(Subquery(secundarios), 0),
+        )
+
+
 class Grupo(models.Model):
     nome = models.CharField(max_length=100, verbose_name='Nome')
     descricao = models.TextField(blank=True, verbose_name='Descrição')
@@ -71,27 +209,45 @@ class Grupo(models.Model):
         verbose_name='Obriga Reconhecimento Facial',
         help_text='Usuários deste grupo devem usar reconhecimento facial para autenticação'
     )
+    hierarquia_cache = models.CharField(
+        max_length=500,
+        blank=True,
+        editable=False,
+        verbose_name='Hierarquia',
+        help_text='Caminho completo da hierarquia, recalculado ao salvar o grupo'
+    )
+    nivel_cache = models.PositiveSmallIntegerField(
+        default=0,
+        editable=False,
+        verbose_name='Nível',
+        help_text='Nível na hierarquia (0 para grupos raiz), recalculado ao salvar o grupo'
+    )
+    caminho_cache = models.CharField(
+        max_length=255,
+        blank=True,
+        editable=False,
+        db_index=True,
+        verbose_name='Caminho',
+        help_text='IDs da raiz até o grupo (ex.: "1/4/17/"), recalculado ao salvar o grupo'
+    )
     data_criacao = models.DateTimeField(auto_now_add=True, verbose_name='Data de Criação')
     data_atualizacao = models.DateTimeField(auto_now=True, verbose_name='Última Atualização')
 
+    objects = GrupoQuerySet.as_manager()
+
     class Meta:
         verbose_name = 'Grupo'
         verbose_name_plural = 'Grupos'
         ordering = ['nome']
 
     def __str__(self):
-        if self.grupo_pai:
-            return f"{self.grupo_pai} > {self.nome}"
-        return self.nome
+        return self.get_hierarquia_completa()
 
     def get_hierarquia_completa(self):
         """Retorna o caminho completo da hierarquia do grupo."""
-        hierarquia = []
-        grupo_atual = self
-        while grupo_atual:
-            hierarquia.insert(0, grupo_atual.nome)
-            grupo_atual = grupo_atual.grupo_pai
-        return ' > '.join(hierarquia)
+        if not self.hierarquia_cache:
+            self._atualizar_cache_hierarquia()
+        return self.hierarquia_cache
 
     def clean(self):
         """Valida para evitar referências circulares na hierarquia."""
@@ -99,38 +255,100 @@ class Grupo(models.Model):
             if self.grupo_pai == self:
                 raise ValidationError('Um grupo não pode ser pai de si mesmo.')
             
-            grupos_pais = set()
-            grupo_atual = self.grupo_pai
-            while grupo_atual:
-                if grupo_atual in grupos_pais:
-                    raise ValidationError('Referência circular detectada na hierarquia de grupos.')
-                if self.pk and grupo_atual.pk == self.pk:
-                    raise ValidationError('Referência circular detectada: este grupo está na sua própria hierarquia pai.')
-                grupos_pais.add(grupo_atual)
-                grupo_atual = grupo_atual.grupo_pai
+            # O caminho materializado do pai escolhido passa por este grupo se o pai for um subgrupo dele
+            if self.pk and self.grupo_pai.pertence_a_subarvore(self):
+                raise ValidationError('Referência circular detectada: este grupo está na sua própria hierarquia pai.')
+
+    def pertence_a_subarvore(self, grupo):
+        """Indica se este grupo é o grupo informado ou um de seus subgrupos."""
+        if grupo.pk is None:
+            return False
+        if grupo.caminho_cache and self.caminho_cache:
+            # Caminhos materializados: comparação de prefixo, sem consultas
+            return self.caminho_cache.startswith(grupo.caminho_cache)
+        # Sem cache, um caminho vazio não prova nada: percorre os pais no banco
+        return any(ancestral.pk == grupo.pk for ancestral in self._cadeia_ate_raiz())
+
+    def save(self, *args, **kwargs):
+        """Override do save para manter a hierarquia em cache atualizada."""
+        hierarquia_anterior = (self.hierarquia_cache, self.caminho_cache)
+        self._atualizar_cache_hierarquia()
+        
+        update_fields = kwargs.get('update_fields')
+        if update_fields is not None and {'nome', 'grupo_pai'} & set(update_fields):
+            kwargs['update_fields'] = set(update_fields) | {'hierarquia_cache', 'nivel_cache', 'caminho_cache'}
+        
+        super().save(*args, **kwargs)
+        
+        # Grupos novos só conhecem o próprio ID depois do INSERT
+        if not self.caminho_cache:
+            self._atualizar_cache_hierarquia()
+            Grupo.objects.filter(pk=self.pk).update(caminho_cache=self.caminho_cache)
+        
+        # Se o caminho mudou, os subgrupos precisam recalcular o próprio cache
+        if (self.hierarquia_cache, self.caminho_cache) != hierarquia_anterior:
+            for subgrupo in self.subgrupos.all():
+                subgrupo.grupo_pai = self
+                subgrupo.save(update_fields=['hierarquia_cache', 'nivel_cache', 'caminho_cache'])
+
+    def _atualizar_cache_hierarquia(self):
+        """Recalcula o caminho e o nível a partir do cache do grupo pai."""
+        if self.grupo_pai and not self.grupo_pai.caminho_cache:
+            # Pai sem cache (ex.: gravado sem passar pelo save): não dá para confiar nele
+            self._calcular_cache_pela_cadeia()
+            return
+        if self.grupo_pai:
+            self.hierarquia_cache = f"{self.grupo_pai.hierarquia_cache} > {self.nome}"
+            self.nivel_cache = self.grupo_pai.nivel_cache + 1
+            caminho_pai = self.grupo_pai.caminho_cache
+        else:
+            self.hierarquia_cache = self.nome
+            self.nivel_cache = 0
+            caminho_pai = ''
+        self.caminho_cache = f"{caminho_pai}{self.pk}/" if self.pk else ''
+
+    def _cadeia_ate_raiz(self):
+        """Retorna o grupo e seus ancestrais (do grupo até a raiz) percorrendo grupo_pai no banco."""
+        cadeia = [self]
+        vistos = {self.pk}
+        try:
+            pai = self.grupo_pai
+        except Grupo.DoesNotExist:
+            # Pai ainda não gravado (loaddata fora de ordem)
+            pai = None
+        while pai is not None and pai.pk not in vistos:
+            cadeia.append(pai)
+            vistos.add(pai.pk)
+            pai = Grupo.objects.filter(pk=pai.grupo_pai_id).first() if pai.grupo_pai_id else None
+        return cadeia
+
+    def _calcular_cache_pela_cadeia(self):
+        """Recalcula hierarquia, nível e caminho sem depender do cache dos ancestrais."""
+        cadeia = list(reversed(self._cadeia_ate_raiz()))
+        self.hierarquia_cache = ' > '.join(grupo.nome for grupo in cadeia)
+        self.nivel_cache = len(cadeia) - 1
+        self.caminho_cache = ''.join(f"{grupo.pk}/" for grupo in cadeia) if self.pk else ''
 
     def get_todos_subgrupos(self):
         """Retorna todos os subgrupos recursivamente."""
-        subgrupos = list(self.subgrupos.all())
-        for subgrupo in self.subgrupos.all():
-            subgrupos.extend(subgrupo.get_todos_subgrupos())
-        return subgrupos
+        return list(Grupo.objects.descendentes_de(self))
 
     def get_nivel_hierarquia(self):
         """Retorna o nível na hierarquia (0 para grupos raiz)."""
-        nivel = 0
-        grupo_atual = self.grupo_pai
-        while grupo_atual:
-            nivel += 1
-            grupo_atual = grupo_atual.grupo_pai
-        return nivel
+        if not self.hierarquia_cache:
+            self._atualizar_cache_hierarquia()
+        return self.nivel_cache
     
     def get_usuarios_primarios_count(self):
         """Retorna a quantidade de usuários que têm este grupo como primário."""
+        if hasattr(self, '_usuarios_primarios_count'):
+            return self._usuarios_primarios_count
         return self.usuarios_primarios.count()
     
     def get_usuarios_secundarios_count(self):
         """Retorna a quantidade de usuários que têm este grupo como secundário."""
+        if hasattr(self, '_usuarios_secundarios_count'):
+            return self._usuarios_secundarios_count
         return self.usuarios_secundarios.count()
     
     def get_total_usuarios(self):
@@ -138,6 +356,49 @@ class Grupo(models.Model):
         return self.get_usuarios_primarios_count() + self.get_usuarios_secundarios_count()
 
 
+@receiver(post_save, sender=Grupo)
+def reconstruir_cache_hierarquia_raw(sender, instance, raw, **kwargs):
+    """Recalcula o cache de grupos gravados pelo loaddata, que não passa pelo Grupo.save()."""
+    if not raw:
+        return
+    instance._calcular_cache_pela_cadeia()
+    Grupo.objects.filter(pk=instance.pk).update(
+        hierarquia_cache=instance.hierarquia_cache,
+        nivel_cache=instance.nivel_cache,
+        caminho_cache=instance.caminho_cache,
+    )
+    # Subgrupos carregados antes do pai ficaram com o cache incompleto
+    for subgrupo in instance.subgrupos.all():
+        subgrupo.grupo_pai = instance
+        subgrupo.save(update_fields=['hierarquia_cache', 'nivel_cache', 'caminho_cache'])
+
+
+@receiver(post_save, sender=Grupo)
+@receiver(post_delete, sender=Grupo)
+def invalidar_cache_lookups_grupos(sender, **kwargs):
+    """Descarta as opções de grupos em cache nos filtros do admin quando um grupo é gravado ou removido."""
+    cache.delete_many(GRUPO_LOOKUPS_CACHE_KEYS)
+
+
+class UsuarioManager(UserManager):
+    """Manager de usuários com consultas pré-carregando os grupos.
+    
+    O encoding facial só é necessário no login facial; por padrão a coluna é
+    adiada (defer) para não trafegar os bytes em toda consulta de usuário.
+    """
+    
+    def get_queryset(self):
+        return super().get_queryset().defer('face_encoding')
+    
+    def com_encoding(self):
+        """Retorna os usuários carregando também o encoding facial, sem a consulta extra do campo adiado."""
+        return self.get_queryset().defer(None)
+    
+    def com_grupos(self):
+        """Retorna os usuários com o setor principal e os secundários já carregados."""
+        return self.get_queryset().select_related('grupo_primario').prefetch_related('grupos_secundarios')
+
+
 class Usuario(AbstractUser):
     grupo_primario = models.ForeignKey(
         'Grupo',
@@ -163,6 +424,12 @@ class Usuario(AbstractUser):
         verbose_name='Encoding Facial',
         help_text='Dados biométricos faciais criptografados'
     )
+    face_encoding_version = models.PositiveIntegerField(
+        default=0,
+        editable=False,
+        verbose_name='Versão do Encoding Facial',
+        help_text='Incrementada a cada novo encoding; invalida os caches de encodings descriptografados'
+    )
     foto_perfil_facial = models.ImageField(
         upload_to='faces/%Y/%m/',
         null=True,
@@ -199,10 +466,25 @@ class Usuario(AbstractUser):
     data_criacao = models.DateTimeField(auto_now_add=True, verbose_name='Data de Criação')
     data_atualizacao = models.DateTimeField(auto_now=True, verbose_name='Última Atualização')
 
+    objects = UsuarioManager()
+
     class Meta:
         verbose_name = 'Usuário'
         verbose_name_plural = 'Usuários'
         ordering = ['username']
+        indexes = [
+            models.Index(fields=['ativo', 'grupo_primario']),
+            models.Index(fields=['reconhecimento_facial_ativo']),
+            # Índice parcial: cobre apenas os usuários carregados na matriz do login facial
+            models.Index(
+                fields=['id'],
+                name='usuarios_facial_ativo_idx',
+                condition=models.Q(
+                    reconhecimento_facial_ativo=True, face_encoding__isnull=False,
+                    ativo=True, permite_reconhecimento_facial=True,
+                ),
+            ),
+        ]
 
     def __str__(self):
         return self.get_full_name() or self.username
@@ -219,7 +501,7 @@ class Usuario(AbstractUser):
         # Validação para evitar que o mesmo setor seja principal e secundário
         if self.grupo_primario and self.pk:
             # Verifica se o setor principal está nos setores secundários
-            if self.grupos_secundarios.filter(id=self.grupo_primario.id).exists():
+            if any(g.id == self.grupo_primario_id for g in self.grupos_secundarios.all()):
                 raise ValidationError(
                     f'O setor "{self.grupo_primario.nome}" não pode ser tanto principal quanto secundário. '
                     'Remova-o dos setores secundários.'
@@ -233,18 +515,19 @@ class Usuario(AbstractUser):
     
     def get_grupos_hierarquia(self):
         """Retorna os setores organizados por hierarquia."""
-        todos_grupos = self.get_todos_grupos()
+        secundarios = list(self.grupos_secundarios.all())
         return {
             'principal': self.grupo_primario,
-            'secundarios': list(self.grupos_secundarios.all()),
-            'todos': todos_grupos
+            'secundarios': secundarios,
+            'todos': ([self.grupo_primario] if self.grupo_primario else []) + secundarios
         }
     
     def pertence_grupo(self, grupo):
         """Verifica se o usuário pertence a um setor específico."""
-        if self.grupo_primario == grupo:
+        if self.grupo_primario_id == grupo.id:
             return True
-        return self.grupos_secundarios.filter(id=grupo.id).exists()
+        # Percorre a lista (pré-carregada quando disponível) em vez de um novo SELECT
+        return any(g.id == grupo.id for g in self.grupos_secundarios.all())
     
     def get_permissoes_grupos(self):
         """Método para futuras implementações de permissões por grupo."""
@@ -257,7 +540,7 @@ class Usuario(AbstractUser):
             return True
         
         # Verifica se há duplicação
-        tem_duplicacao = self.grupos_secundarios.filter(id=self.grupo_primario.id).exists()
+        tem_duplicacao = any(g.id == self.grupo_primario_id for g in self.grupos_secundarios.all())
         
         if tem_duplicacao:
             if raise_exception:
@@ -268,62 +551,128 @@ class Usuario(AbstractUser):
         
         return True
     
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        """Guarda o setor principal e o estado facial carregados do banco para detectar mudanças no save."""
+        instance = super().from_db(db, field_names, values)
+        instance._grupo_primario_id_original = instance.__dict__.get('grupo_primario_id')
+        instance._estado_facial_original = instance._estado_facial()
+        return instance
+    
+    def _estado_facial(self):
+        """Valores que definem a linha do usuário na matriz de encodings do login facial."""
+        # Campos adiados (face_encoding, por padrão) ficam fora do __dict__ e
+        # contam como inalterados enquanto não forem carregados ou atribuídos
+        return tuple(self.__dict__.get(campo, _NAO_CARREGADO) for campo in CAMPOS_MATRIZ_FACIAL)
+    
+    def _estado_facial_mudou(self):
+        """Indica se o estado facial em memória difere do carregado do banco."""
+        original = getattr(self, '_estado_facial_original', None)
+        if original is None:
+            # Instância nova: só entra na matriz se já tiver encoding ativo
+            return bool(self.reconhecimento_facial_ativo and self.__dict__.get('face_encoding'))
+        return any(
+            atual is not _NAO_CARREGADO and atual != anterior
+            for atual, anterior in zip(self._estado_facial(), original)
+        )
+    
     def save(self, *args, **kwargs):
-        """Override do save para validar setores únicos."""
-        # Valida antes de salvar (para casos sem m2m ainda)
-        if self.pk and hasattr(self, '_state') and not self._state.adding:
-            self.clean()
-        
-        # Salva primeiro para que o objeto tenha um ID
+        """Override do save para manter os setores únicos."""
+        # A validação (clean) fica a cargo dos formulários; aqui apenas salva e
+        # corrige a duplicação entre setor principal e secundários
+        adding = self._state.adding
         super().save(*args, **kwargs)
+        self.__dict__.pop('_setores_permitem_facial', None)
+        self.__dict__.pop('_setores_obrigam_facial', None)
         
-        # Depois valida e corrige os setores para evitar duplicação
-        self._corrigir_setores_duplicados()
+        # Só a troca do setor principal pode fazê-lo coincidir com um secundário;
+        # usuários recém-criados ainda não têm setores secundários
+        if not adding and self.grupo_primario_id != getattr(self, '_grupo_primario_id_original', None):
+            self._corrigir_setores_duplicados()
+        self._grupo_primario_id_original = self.grupo_primario_id
+        
+        # Só mudanças nos campos da matriz do login facial a tornam obsoleta;
+        # edições comuns de perfil não forçam sua reconstrução
+        update_fields = kwargs.get('update_fields')
+        if update_fields is None or set(CAMPOS_MATRIZ_FACIAL) & set(update_fields):
+            if self._estado_facial_mudou():
+                self.invalidar_cache_encodings()
+            self._estado_facial_original = self._estado_facial()
+    
+    @staticmethod
+    def invalidar_cache_encodings():
+        """Invalida a matriz de encodings faciais mantida em cache pelo login facial."""
+        try:
+            cache.incr(FACIAL_ENCODINGS_VERSION_KEY)
+        except ValueError:
+            cache.set(FACIAL_ENCODINGS_VERSION_KEY, 1, None)
+        
+        # Os encodings descriptografados deste processo saem junto; os demais
+        # processos os descartam ao montar a nova matriz
+        try:
+            from .facial_security import limpar_encodings_decifrados
+        except ImportError:
+            return
+        limpar_encodings_decifrados()
     
     def _corrigir_setores_duplicados(self):
         """Corrige automaticamente setores duplicados removendo do secundário."""
-        if not self.grupo_primario or not self.pk:
+        if not self.grupo_primario_id or not self.pk:
             return
         
-        # Verifica e remove o setor principal dos secundários se existir
-        if self.grupos_secundarios.filter(id=self.grupo_primario.id).exists():
-            self.grupos_secundarios.remove(self.grupo_primario)
-            print(f'Auto-correcção: Setor "{self.grupo_primario.nome}" removido dos secundários pois já é principal.')
+        # Remove o setor principal dos secundários com um único DELETE
+        removidos, _ = self.grupos_secundarios.through.objects.filter(
+            usuario_id=self.pk, grupo_id=self.grupo_primario_id
+        ).delete()
+        if removidos:
+            logger.info(
+                'Auto-correcção: Setor "%s" removido dos secundários pois já é principal.', self.grupo_primario.nome
+            )
     
-    def pode_usar_reconhecimento_facial(self):
-        """Verifica se o usuário pode usar reconhecimento facial."""
-        if not self.permite_reconhecimento_facial:
-            return False
-        
+    @cached_property
+    def _setores_permitem_facial(self):
+        """Indica se algum setor do usuário permite reconhecimento facial (calculado uma vez por instância)."""
         # Verifica permissão do grupo principal
         if self.grupo_primario and self.grupo_primario.permite_uso_reconhecimento_facial:
             return True
         
         # Verifica permissão nos grupos secundários
-        return self.grupos_secundarios.filter(permite_uso_reconhecimento_facial=True).exists()
+        return any(g.permite_uso_reconhecimento_facial for g in self.grupos_secundarios.all())
     
-    def requer_reconhecimento_facial(self):
-        """Verifica se o usuário é obrigado a usar reconhecimento facial."""
-        if not self.reconhecimento_facial_ativo:
-            return False
-            
+    @cached_property
+    def _setores_obrigam_facial(self):
+        """Indica se algum setor do usuário obriga reconhecimento facial (calculado uma vez por instância)."""
         # Verifica se o grupo principal obriga reconhecimento facial
         if self.grupo_primario and self.grupo_primario.obriga_reconhecimento_facial:
             return True
         
         # Verifica se algum grupo secundário obriga
-        return self.grupos_secundarios.filter(obriga_reconhecimento_facial=True).exists()
+        return any(g.obriga_reconhecimento_facial for g in self.grupos_secundarios.all())
+    
+    def pode_usar_reconhecimento_facial(self):
+        """Verifica se o usuário pode usar reconhecimento facial."""
+        if not self.permite_reconhecimento_facial:
+            return False
+        return self._setores_permitem_facial
+    
+    def requer_reconhecimento_facial(self):
+        """Verifica se o usuário é obrigado a usar reconhecimento facial."""
+        if not self.reconhecimento_facial_ativo:
+            return False
+        return self._setores_obrigam_facial
     
     def resetar_tentativas_facial(self):
         """Reseta o contador de tentativas falhas."""
+        Usuario.objects.filter(pk=self.pk).update(tentativas_falhas_facial=0)
         self.tentativas_falhas_facial = 0
-        self.save(update_fields=['tentativas_falhas_facial'])
     
     def incrementar_tentativas_facial(self):
         """Incrementa o contador de tentativas falhas."""
-        self.tentativas_falhas_facial += 1
-        self.save(update_fields=['tentativas_falhas_facial'])
-        return self.tentativas_falhas_facial
+        # Incremento atômico no banco, sem perder tentativas simultâneas. O valor em
+        # memória é descartado: volta a ser lido do banco se acessado, e um save()
+        # posterior não sobrescreve o contador com um valor antigo
+        Usuario.objects.filter(pk=self.pk).update(tentativas_falhas_facial=F('tentativas_falhas_facial') + 1)
+        self.__dict__.pop('tentativas_falhas_facial', None)
     
     def otimizar_foto_facial(self):
         """Otimiza a foto facial redimensionando e comprimindo se necessário."""
@@ -334,12 +683,15 @@ class Usuario(AbstractUser):
             # Abre a imagem
             image = Image.open(self.foto_perfil_facial)
             
+            # Em JPEGs, decodifica já reduzido pelo libjpeg (1/2, 1/4 ou 1/8), sem ficar abaixo de max_size
+            max_size = 800
+            image.draft('RGB', (max_size, max_size))
+            
             # Converte para RGB se necessário
-            if image.mode in ('RGBA', 'LA', 'P'):
+            if image.mode != 'RGB':
                 image = image.convert('RGB')
             
             # Redimensiona se muito grande, mantendo a proporção
-            max_size = 800
             if image.width > max_size or image.height > max_size:
                 image.thumbnail((max_size, max_size), Image.Resampling.LANCZOS)
             
@@ -348,20 +700,18 @@ class Usuario(AbstractUser):
             image.save(output, format='JPEG', quality=85, optimize=True)
             output.seek(0)
             
-            # Atualiza o campo com a imagem otimizada
+            # Atualiza o campo com a imagem otimizada; o storage copia o buffer
+            # em blocos (chunks), sem gerar uma segunda cópia com getvalue()
             self.foto_perfil_facial.save(
                 self.foto_perfil_facial.name,
-                InMemoryUploadedFile(
-                    output, 'ImageField', self.foto_perfil_facial.name,
-                    'image/jpeg', len(output.getvalue()), None
-                ),
+                File(output, name=self.foto_perfil_facial.name),
                 save=False
             )
             
             return True
             
-        except Exception as e:
-            print(f"Erro ao otimizar foto facial: {e}")
+        except Exception:
+            logger.exception("Erro ao otimizar foto facial")
             return False
 
 
@@ -446,6 +796,36 @@ class RegistroAcessoFacial(models.Model):
         """Override para atualizar o último acesso do usuário se for sucesso."""
         super().save(*args, **kwargs)
         
-        if self.usuario and self.sucesso and self.tipo_acesso in ['entrada', 'saida']:
-            self.usuario.ultimo_acesso_facial = self.data_hora
-            self.usuario.save(update_fields=['ultimo_acesso_facial'])
\ No newline at end of file
+        if self.atualiza_ultimo_acesso:
+            Usuario.objects.filter(pk=self.usuario_id).update(ultimo_acesso_facial=self.data_hora)
+            if RegistroAcessoFacial.usuario.is_cached(self):
+                self.usuario.ultimo_acesso_facial = self.data_hora
+    
+    @property
+    def atualiza_ultimo_acesso(self):
+        """Indica se o registro deve atualizar o último acesso do usuário."""
+        return bool(self.usuario_id and self.sucesso and self.tipo_acesso in ['entrada', 'saida'])
+    
+    @classmethod
+    def registrar_em_lote(cls, registros, batch_size=500):
+        """
+        Grava vários registros com um único bulk_create e atualiza o último
+        acesso dos usuários com um único UPDATE (bulk_create não chama save()).
+        """
+        registros = cls.objects.bulk_create(registros, batch_size=batch_size)
+        
+        ultimos_acessos = {}
+        for registro in registros:
+            if registro.atualiza_ultimo_acesso:
+                atual = ultimos_acessos.get(registro.usuario_id)
+                if atual is None or registro.data_hora > atual:
+                    ultimos_acessos[registro.usuario_id] = registro.data_hora
+        
+        if ultimos_acessos:
+            Usuario.objects.filter(pk__in=ultimos_acessos).update(
+                ultimo_acesso_facial=Case(
+                    *[When(pk=pk, then=Value(data_hora)) for pk, data_hora in ultimos_acessos.items()],
+                    output_field=models.DateTimeField(),
+                )
+            )
+        return registros
@@ -0,0 +1,210 @@
+import pickle
+import shutil
+import tempfile
+from unittest import skipUnless
+
+from django.core.cache import cache
+from django.core.exceptions import ValidationError
+from django.core.management import call_command
+from django.test import TestCase, override_settings
+
+from . import auditoria
+from .admin import GrupoAdminForm
+from .facial_security import (
+    ENCRYPTION_VERSION_AESGCM, FACIAL_LIBS_AVAILABLE, _decrypt_encoding_cached,
+    _encodings_decifrados, facial_manager, limpar_encodings_decifrados,
+)
+from .models import Grupo, RegistroAcessoFacial, Usuario
+
+if FACIAL_LIBS_AVAILABLE:
+    import numpy as np
+
+
+def _encoding_aleatorio(semente=0):
+    """Gera um encoding de 128 posições como os do face_recognition."""
+    return np.random.default_rng(semente).uniform(-0.5, 0.5, 128)
+
+
+@skipUnless(FACIAL_LIBS_AVAILABLE, 'Bibliotecas de reconhecimento facial não disponíveis')
+class CriptografiaEncodingTests(TestCase):
+    """Criptografia dos encodings faciais e cache dos encodings descriptografados."""
+
+    def setUp(self):
+        cache.clear()
+        limpar_encodings_decifrados()
+
+    def test_ida_e_volta_aes_gcm(self):
+        encoding = _encoding_aleatorio()
+        token = facial_manager.encrypt_encoding(encoding)
+
+        self.assertEqual(token[:1], ENCRYPTION_VERSION_AESGCM)
+        self.assertNotEqual(token, facial_manager.encrypt_encoding(encoding))  # nonce novo a cada gravação
+        np.testing.assert_allclose(facial_manager.decrypt_encoding(token), encoding.astype(np.float32))
+
+    def test_le_fernet_legado(self):
+        encoding = _encoding_aleatorio(1)
+        # Formato original (pickle do array) e o intermediário (float32 bruto), ambos em Fernet
+        legado_pickle = facial_manager.cipher.encrypt(pickle.dumps(encoding))
+        legado_bruto = facial_manager.cipher.encrypt(encoding.astype(np.float32).tobytes())
+
+        np.testing.assert_allclose(facial_manager.decrypt_encoding(legado_pickle), encoding)
+        np.testing.assert_allclose(facial_manager.decrypt_encoding(legado_bruto), encoding.astype(np.float32))
+
+    def test_recusa_token_adulterado(self):
+        token = bytearray(facial_manager.encrypt_encoding(_encoding_aleatorio()))
+        token[-1] ^= 0xFF
+
+        with self.assertLogs('usuarios.facial_security', 'ERROR'):
+            self.assertIsNone(facial_manager.decrypt_encoding(bytes(token)))
+
+    def test_cache_por_usuario_e_versao(self):
+        antigo = facial_manager.encrypt_encoding(_encoding_aleatorio(1))
+        novo = facial_manager.encrypt_encoding(_encoding_aleatorio(2))
+
+        primeiro = _decrypt_encoding_cached(1, 1, antigo)
+        self.assertIs(_decrypt_encoding_cached(1, 1, antigo), primeiro)
+        # Um novo cadastro (nova versão) não reaproveita o encoding anterior
+        np.testing.assert_allclose(_decrypt_encoding_cached(1, 2, novo), _encoding_aleatorio(2).astype(np.float32))
+
+        limpar_encodings_decifrados(manter={(1, 2)})
+        self.assertEqual(list(_encodings_decifrados), [(1, 2)])
+
+    def test_invalidar_cache_descarta_encodings_decifrados(self):
+        _decrypt_encoding_cached(1, 1, facial_manager.encrypt_encoding(_encoding_aleatorio()))
+
+        Usuario.invalidar_cache_encodings()
+
+        self.assertEqual(len(_encodings_decifrados), 0)
+
+
+class HierarquiaGrupoTests(TestCase):
+    """Caminho materializado da hierarquia de grupos e a checagem de ciclos."""
+
+    def setUp(self):
+        self.raiz = Grupo.objects.create(nome='Raiz')
+        self.filho = Grupo.objects.create(nome='Filho', grupo_pai=self.raiz)
+        self.neto = Grupo.objects.create(nome='Neto', grupo_pai=self.filho)
+
+    def test_caminho_e_nivel(self):
+        self.neto.refresh_from_db()
+        self.assertEqual(self.neto.caminho_cache, f'{self.raiz.pk}/{self.filho.pk}/{self.neto.pk}/')
+        self.assertEqual(self.neto.nivel_cache, 2)
+        self.assertEqual(self.neto.hierarquia_cache, 'Raiz > Filho > Neto')
+
+    def test_mudanca_propaga_para_subgrupos(self):
+        outra_raiz = Grupo.objects.create(nome='Outra')
+        self.filho.grupo_pai = outra_raiz
+        self.filho.nome = 'Movido'
+        self.filho.save()
+
+        self.neto.refresh_from_db()
+        self.assertEqual(self.neto.caminho_cache, f'{outra_raiz.pk}/{self.filho.pk}/{self.neto.pk}/')
+        self.assertEqual(self.neto.hierarquia_cache, 'Outra > Movido > Neto')
+        self.assertEqual(list(Grupo.objects.descendentes_de(self.raiz)), [])
+
+    def test_descendentes(self):
+        self.assertCountEqual(Grupo.objects.descendentes_de(self.raiz), [self.filho, self.neto])
+        self.assertCountEqual(Grupo.objects.descendentes_de(self.neto), [])
+
+    def test_clean_recusa_ciclos(self):
+        self.raiz.grupo_pai = self.neto
+        with self.assertRaises(ValidationError):
+            self.raiz.clean()
+
+        self.raiz.grupo_pai = self.raiz
+        with self.assertRaises(ValidationError):
+            self.raiz.clean()
+
+        self.neto.grupo_pai = self.raiz
+        self.neto.clean()
+
+    def test_formulario_admin_recusa_subgrupo_como_pai(self):
+        form = GrupoAdminForm(instance=self.raiz, data={'nome': 'Raiz', 'grupo_pai': self.neto.pk, 'ativo': True})
+
+        self.assertFalse(form.is_valid())
+        self.assertIn('grupo_pai', form.errors)
+
+    def test_loaddata_calcula_o_cache(self):
+        Grupo.objects.all().delete()
+        call_command('loaddata', 'grupos_iniciais', verbosity=0)
+
+        suporte = Grupo.objects.get(pk=10)
+        self.assertEqual(suporte.caminho_cache, '1/3/10/')
+        self.assertEqual(suporte.nivel_cache, 2)
+        self.assertEqual(suporte.hierarquia_cache, 'Administração > Tecnologia da Informação > Suporte')
+
+
+@skipUnless(FACIAL_LIBS_AVAILABLE, 'Bibliotecas de reconhecimento facial não disponíveis')
+class MatrizEncodingsTests(TestCase):
+    """Usuários que entram na matriz de encodings do login facial."""
+
+    def setUp(self):
+        cache.clear()
+        limpar_encodings_decifrados()
+        self.grupo = Grupo.objects.create(nome='Setor', permite_uso_reconhecimento_facial=True)
+
+    def _criar_usuario(self, username, **campos):
+        usuario = Usuario.objects.create_user(username, password='x', grupo_primario=self.grupo)
+        valores = {
+            'face_encoding': facial_manager.encrypt_encoding(_encoding_aleatorio(usuario.pk)),
+            'reconhecimento_facial_ativo': True,
+            'permite_reconhecimento_facial': True,
+            'ativo': True,
+        }
+        valores.update(campos)
+        Usuario.objects.filter(pk=usuario.pk).update(**valores)
+        return usuario
+
+    def test_apenas_usuarios_habilitados(self):
+        habilitado = self._criar_usuario('habilitado')
+        self._criar_usuario('inativo', ativo=False)
+        self._criar_usuario('sem_permissao', permite_reconhecimento_facial=False)
+        self._criar_usuario('desativado', reconhecimento_facial_ativo=False)
+        self._criar_usuario('sem_encoding', face_encoding=None)
+        Usuario.invalidar_cache_encodings()
+
+        version, ids, versoes, matrix, normas = facial_manager._carregar_matriz()
+
+        self.assertEqual(ids.tolist(), [habilitado.pk])
+        self.assertEqual(matrix.shape, (1, 128))
+
+
+class AuditoriaAcessoFacialTests(TestCase):
+    """Gravação dos registros de acesso facial no modo síncrono (padrão)."""
+
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media_root, ignore_errors=True)
+        configuracao = override_settings(MEDIA_ROOT=self.media_root, FACIAL_AUDIT_ASYNC=False)
+        configuracao.enable()
+        self.addCleanup(configuracao.disable)
+        grupo = Grupo.objects.create(nome='Setor')
+        self.usuario = Usuario.objects.create_user('auditado', password='x', grupo_primario=grupo)
+
+    def test_grava_na_hora(self):
+        auditoria.registrar_acesso(
+            foto_nome='acesso.webp',
+            foto_bytes=b'RIFF0000WEBP',
+            usuario=self.usuario,
+            tipo_acesso='entrada',
+            sucesso=True,
+            ip_origem='127.0.0.1',
+        )
+
+        registro = RegistroAcessoFacial.objects.get()
+        self.assertEqual(registro.usuario, self.usuario)
+        self.assertTrue(registro.foto_capturada.name.endswith('.webp'))
+        with open(registro.foto_capturada.path, 'rb') as foto:
+            self.assertEqual(foto.read(), b'RIFF0000WEBP')
+        self.usuario.refresh_from_db()
+        self.assertEqual(self.usuario.ultimo_acesso_facial, registro.data_hora)
+        # Sem o modo assíncrono nenhuma thread de gravação é iniciada
+        self.assertIsNone(auditoria._worker)
+
+    def test_falha_nao_atualiza_ultimo_acesso(self):
+        auditoria.registrar_acesso(tipo_acesso='tentativa_falha', sucesso=False)
+
+        registro = RegistroAcessoFacial.objects.get()
+        self.assertIsNone(registro.usuario)
+        self.usuario.refresh_from_db()
+        self.assertIsNone(self.usuario.ultimo_acesso_facial)
@@ -10,20 +10,50 @@ from django.utils import timezone
 from django.core.files.base import ContentFile
 from django.conf import settings
 from django.core.exceptions import ValidationError
+from PIL import Image
 import base64
+import io
 import json
+import logging
 from .forms import PerfilUsuarioForm, AlterarSenhaForm
-from .models import Usuario, RegistroAcessoFacial
+from .models import Usuario, RegistroAcessoFacial, validate_facial_image, verificar_arquivo_facial
+from .auditoria import registrar_acesso
 
 # Importações condicionais para reconhecimento facial
 try:
     import cv2
     import numpy as np
-    from .facial_security import FacialSecurityManager
+    from .facial_security import facial_manager
     FACIAL_RECOGNITION_AVAILABLE = True
 except ImportError:
     FACIAL_RECOGNITION_AVAILABLE = False
 
+# Codificador JPEG baseado em libjpeg-turbo (opcional), mais rápido que o do OpenCV
+try:
+    import simplejpeg
+    SIMPLEJPEG_AVAILABLE = True
+except ImportError:
+    SIMPLEJPEG_AVAILABLE = False
+
+# Parser JSON mais rápido (opcional), que lê os bytes do corpo direto
+try:
+    import orjson
+    ORJSON_AVAILABLE = True
+except ImportError:
+    ORJSON_AVAILABLE = False
+
+# Decodificador base64 vetorizado (opcional), com a mesma API do módulo padrão
+try:
+    import pybase64
+    PYBASE64_AVAILABLE = True
+except ImportError:
+    PYBASE64_AVAILABLE = False
+
+logger = logging.getLogger(__name__)
+
+# Tipos aceitos como corpo binário nos endpoints faciais (alternativa ao JSON com base64)
+RAW_IMAGE_CONTENT_TYPES = ('image/jpeg', 'image/png')
+
 
 class CustomLoginView(LoginView):
     template_name = 'usuarios/login.html'
@@ -32,25 +62,31 @@ class CustomLoginView(LoginView):
 
 @login_required
 def dashboard(request):
+    # Carrega os setores junto com o usuário para as verificações do template
+    usuario = Usuario.objects.com_grupos().get(pk=request.user.pk)
     context = {
-        'usuario': request.user,
+        'usuario': usuario,
+        'user': usuario,
     }
     return render(request, 'usuarios/dashboard.html', context)
 
 
 @login_required
 def perfil(request):
+    # Carrega os setores junto com o usuário para o formulário e o template
+    usuario = Usuario.objects.com_grupos().get(pk=request.user.pk)
     if request.method == 'POST':
-        form = PerfilUsuarioForm(request.POST, instance=request.user)
+        form = PerfilUsuarioForm(request.POST, instance=usuario)
         if form.is_valid():
             form.save()
             messages.success(request, 'Perfil atualizado com sucesso!')
             return redirect('perfil')
     else:
-        form = PerfilUsuarioForm(instance=request.user)
+        form = PerfilUsuarioForm(instance=usuario)
     
     context = {
         'form': form,
+        'user': usuario,
     }
     return render(request, 'usuarios/perfil.html', context)
 
@@ -77,10 +113,21 @@ def get_client_ip(request):
     """Obtém o IP do cliente."""
     x_forwarded_for = request.META.get('HTTP_X_FORWARDED_FOR')
     if x_forwarded_for:
-        ip = x_forwarded_for.split(',')[0]
-    else:
-        ip = request.META.get('REMOTE_ADDR')
-    return ip
+        # O primeiro endereço da lista é o do cliente
+        return x_forwarded_for.partition(',')[0].strip()
+    return request.META.get('REMOTE_ADDR')
+
+
+def get_client_device(request):
+    """Obtém o User-Agent do cliente, limitado ao tamanho do campo dispositivo."""
+    return request.META.get('HTTP_USER_AGENT', '')[:200]
+
+
+def carregar_json(corpo):
+    """Interpreta o corpo JSON da requisição, com orjson quando disponível."""
+    if ORJSON_AVAILABLE:
+        return orjson.loads(corpo)
+    return json.loads(corpo)
 
 
 def decode_base64_image(image_data):
@@ -93,20 +140,60 @@ def decode_base64_image(image_data):
         if ',' in image_data:
             image_data = image_data.split(',')[1]
         
-        # Decodifica base64
-        image_bytes = base64.b64decode(image_data)
-        
-        # Converte para numpy array
-        nparr = np.frombuffer(image_bytes, np.uint8)
-        
-        # Decodifica como imagem
-        image = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
-        
-        return image
+        # Decodifica o base64 e passa os bytes ao OpenCV sem cópia intermediária
+        b64decode = pybase64.b64decode if PYBASE64_AVAILABLE else base64.b64decode
+        return decode_image_bytes(b64decode(image_data, validate=False))
+    except Exception as e:
+        return None
+
+
+def decode_image_bytes(image_bytes):
+    """Converte bytes JPEG/PNG para array OpenCV, reduzindo frames grandes."""
+    if not FACIAL_RECOGNITION_AVAILABLE:
+        return None
+    
+    try:
+        # Frames maiores que o tamanho de detecção não melhoram o reconhecimento
+        max_side = facial_manager.detect_max_side
+        image = cv2.imdecode(np.frombuffer(image_bytes, np.uint8), _flag_decodificacao(image_bytes, max_side))
+        if image is None:
+            return None
+        return facial_manager.reduzir_imagem(image, max_side)
     except Exception as e:
         return None
 
 
+def _flag_decodificacao(image_bytes, max_side):
+    """
+    Escolhe a decodificação reduzida (1/2, 1/4 ou 1/8) do libjpeg quando o JPEG
+    é grande o bastante para continuar com pelo menos max_side pixels.
+    """
+    if not max_side or not image_bytes.startswith(b'\xff\xd8'):
+        return cv2.IMREAD_COLOR
+    
+    # As dimensões vêm só do cabeçalho, sem decodificar a imagem
+    try:
+        with Image.open(io.BytesIO(image_bytes)) as header:
+            maior_lado = max(header.size)
+    except Exception:
+        return cv2.IMREAD_COLOR
+    
+    for fator, flag in ((8, cv2.IMREAD_REDUCED_COLOR_8), (4, cv2.IMREAD_REDUCED_COLOR_4), (2, cv2.IMREAD_REDUCED_COLOR_2)):
+        if maior_lado >= max_side * fator:
+            return flag
+    return cv2.IMREAD_COLOR
+
+
+def encode_jpeg_image(image):
+    """Codifica um array OpenCV (BGR) como bytes JPEG."""
+    if SIMPLEJPEG_AVAILABLE:
+        # Mesma qualidade padrão do cv2.imencode
+        return simplejpeg.encode_jpeg(np.ascontiguousarray(image), quality=95, colorspace='BGR')
+    
+    _, buffer = cv2.imencode('.jpg', image)
+    return buffer.tobytes()
+
+
 @login_required
 def cadastrar_face(request):
     """View para cadastro de reconhecimento facial."""
@@ -122,46 +209,44 @@ def cadastrar_face(request):
     
     if request.method == 'POST':
         try:
-            data = json.loads(request.body)
-            image_data = data.get('image')
-            
-            if not image_data:
-                return JsonResponse({'success': False, 'message': 'Imagem não fornecida'})
-            
-            # Converte base64 para imagem
-            image = decode_base64_image(image_data)
+            if request.content_type in RAW_IMAGE_CONTENT_TYPES:
+                # Corpo binário: dispensa o JSON e a decodificação base64
+                if not request.body:
+                    return JsonResponse({'success': False, 'message': 'Imagem não fornecida'})
+                image = decode_image_bytes(request.body)
+            else:
+                data = carregar_json(request.body)
+                image_data = data.get('image')
+                
+                if not image_data:
+                    return JsonResponse({'success': False, 'message': 'Imagem não fornecida'})
+                
+                # Converte base64 para imagem
+                image = decode_base64_image(image_data)
             if image is None:
                 return JsonResponse({'success': False, 'message': 'Erro ao processar imagem'})
             
             # Processa o cadastro facial
-            facial_manager = FacialSecurityManager()
             success, message = facial_manager.register_face(request.user, image)
             
             if success:
-                # Salva a foto de perfil facial
-                if FACIAL_RECOGNITION_AVAILABLE:
-                    _, buffer = cv2.imencode('.jpg', image)
-                    image_file = ContentFile(buffer.tobytes())
-                    filename = f'perfil_facial_{request.user.id}_{timezone.now().strftime("%Y%m%d_%H%M%S")}.jpg'
-                    request.user.foto_perfil_facial.save(filename, image_file)
-                    
-                    # Registra o evento
-                    _, buffer = cv2.imencode('.jpg', image)
-                    foto_file = ContentFile(buffer.tobytes())
+                # Salva a foto de perfil facial, codificando o JPEG uma única vez
+                # para a foto de perfil e o registro
+                jpeg_bytes = encode_jpeg_image(image)
+                filename = f'perfil_facial_{request.user.id}_{timezone.now().strftime("%Y%m%d_%H%M%S")}.jpg'
+                request.user.foto_perfil_facial.save(filename, ContentFile(jpeg_bytes))
                 
-                registro = RegistroAcessoFacial.objects.create(
+                # Registra o evento (gravado em segundo plano junto com a foto)
+                registrar_acesso(
+                    foto_nome=f'cadastro_{request.user.id}_{timezone.now().strftime("%Y%m%d_%H%M%S")}.jpg',
+                    foto_bytes=jpeg_bytes,
                     usuario=request.user,
                     tipo_acesso='cadastro',
                     ip_origem=get_client_ip(request),
                     sucesso=True,
                     observacoes='Cadastro facial realizado com sucesso',
-                    dispositivo=request.META.get('HTTP_USER_AGENT', '')[:200]
+                    dispositivo=get_client_device(request)
                 )
-                if FACIAL_RECOGNITION_AVAILABLE:
-                    registro.foto_capturada.save(
-                        f'cadastro_{request.user.id}_{timezone.now().strftime("%Y%m%d_%H%M%S")}.jpg',
-                        foto_file
-                    )
                 
                 messages.success(request, 'Face cadastrada com sucesso!')
             
@@ -186,26 +271,32 @@ def login_facial(request):
         return JsonResponse({'success': False, 'message': 'Funcionalidade de reconhecimento facial não disponível'})
     
     try:
-        data = json.loads(request.body)
-        image_data = data.get('image')
-        username = data.get('username', '')  # Opcional: username para busca direcionada
-        
-        if not image_data:
-            return JsonResponse({'success': False, 'message': 'Imagem não fornecida'})
-        
-        # Converte base64 para imagem
-        image = decode_base64_image(image_data)
+        if request.content_type in RAW_IMAGE_CONTENT_TYPES:
+            # Corpo binário: dispensa o JSON e a decodificação base64
+            username = request.GET.get('username', '')  # Opcional: username para busca direcionada
+            if not request.body:
+                return JsonResponse({'success': False, 'message': 'Imagem não fornecida'})
+            image = decode_image_bytes(request.body)
+        else:
+            data = carregar_json(request.body)
+            image_data = data.get('image')
+            username = data.get('username', '')  # Opcional: username para busca direcionada
+            
+            if not image_data:
+                return JsonResponse({'success': False, 'message': 'Imagem não fornecida'})
+            
+            # Converte base64 para imagem
+            image = decode_base64_image(image_data)
         if image is None:
             return JsonResponse({'success': False, 'message': 'Erro ao processar imagem'})
         
         # Processa o login facial
-        facial_manager = FacialSecurityManager()
-        
         # Se username foi fornecido, busca usuário específico
         target_user = None
         if username:
             try:
-                target_user = Usuario.objects.get(username=username, ativo=True)
+                # O encoding vem na mesma consulta, pois process_facial_login o compara
+                target_user = Usuario.objects.com_encoding().get(username=username, ativo=True)
                 if not target_user.pode_usar_reconhecimento_facial():
                     return JsonResponse({
                         'success': False, 
@@ -216,25 +307,19 @@ def login_facial(request):
         
         result = facial_manager.process_facial_login(image, target_user)
         
-        # Registra a tentativa de acesso
-        registro = RegistroAcessoFacial.objects.create(
+        # Registra a tentativa de acesso (gravada em segundo plano junto com a foto)
+        registrar_acesso(
+            foto_nome=f'login_{timezone.now().strftime("%Y%m%d_%H%M%S")}.webp',
+            foto_imagem=image,
             usuario=result.get('user'),
             tipo_acesso='entrada' if result['success'] else 'tentativa_falha',
             confianca=result.get('confidence', 0),
             ip_origem=get_client_ip(request),
             sucesso=result['success'],
             observacoes=result['message'],
-            dispositivo=request.META.get('HTTP_USER_AGENT', '')[:200]
+            dispositivo=get_client_device(request)
         )
         
-        if FACIAL_RECOGNITION_AVAILABLE:
-            _, buffer = cv2.imencode('.jpg', image)
-            foto_file = ContentFile(buffer.tobytes())
-            registro.foto_capturada.save(
-                f'login_{timezone.now().strftime("%Y%m%d_%H%M%S")}.jpg',
-                foto_file
-            )
-        
         # Se login bem-sucedido, autentica o usuário
         if result['success'] and result['user']:
             login(request, result['user'])
@@ -252,8 +337,12 @@ def historico_facial(request):
     if not request.user.pode_usar_reconhecimento_facial():
         return HttpResponseForbidden('Acesso negado')
     
+    # Apenas as colunas exibidas no template
     registros = RegistroAcessoFacial.objects.filter(
         usuario=request.user
+    ).only(
+        'data_hora', 'tipo_acesso', 'confianca', 'foto_capturada',
+        'ip_origem', 'sucesso', 'observacoes'
     ).order_by('-data_hora')[:50]  # Últimos 50 registros
     
     context = {
@@ -284,13 +373,13 @@ def remover_facial(request):
         request.user.save()
         
         # Registra a remoção
-        RegistroAcessoFacial.objects.create(
+        registrar_acesso(
             usuario=request.user,
             tipo_acesso='atualizacao',
             ip_origem=get_client_ip(request),
             sucesso=True,
             observacoes='Cadastro facial removido pelo usuário',
-            dispositivo=request.META.get('HTTP_USER_AGENT', '')[:200]
+            dispositivo=get_client_device(request)
         )
         
         messages.success(request, 'Cadastro facial removido com sucesso!')
@@ -317,7 +406,12 @@ def facial_login_page(request):
 @permission_required('usuarios.view_registroacessofacial', raise_exception=True)
 def admin_historico_facial(request):
     """View para administradores visualizarem todos os logs faciais."""
-    registros = RegistroAcessoFacial.objects.all().order_by('-data_hora')[:100]
+    # Usuário carregado no mesmo JOIN, com só os campos usados para identificá-lo
+    registros = RegistroAcessoFacial.objects.select_related('usuario').only(
+        'data_hora', 'tipo_acesso', 'confianca', 'foto_capturada', 'ip_origem',
+        'sucesso', 'observacoes', 'usuario__username', 'usuario__first_name',
+        'usuario__last_name'
+    ).order_by('-data_hora')[:100]
     
     context = {
         'registros': registros,
@@ -343,23 +437,31 @@ def atualizar_foto_facial(request):
             messages.error(request, 'Nenhuma foto foi selecionada.')
             return redirect('atualizar_foto_facial')
         
+        # Recusa arquivos grandes demais ou de outro formato antes de tocar no modelo
+        erro = verificar_arquivo_facial(foto)
+        if erro:
+            messages.error(request, f'Erro na validação da imagem: {erro}')
+            return redirect('atualizar_foto_facial')
+        
         try:
             # Salva a foto antiga para possível rollback
             foto_antiga = request.user.foto_perfil_facial.name if request.user.foto_perfil_facial else None
             
+            # Valida só a foto (os demais campos do usuário não mudam aqui); tamanho e
+            # formato já foram conferidos acima
+            validate_facial_image(foto, verificar_arquivo=False)
+            
             # Atualiza a foto
             request.user.foto_perfil_facial = foto
-            request.user.full_clean()  # Valida o modelo
             
             # Otimiza a foto
             if request.user.otimizar_foto_facial():
-                print("Foto otimizada com sucesso")
+                logger.debug("Foto otimizada com sucesso")
             
             # Processa para reconhecimento facial se disponível
             if FACIAL_RECOGNITION_AVAILABLE:
                 try:
-                    manager = FacialSecurityManager()
-                    success = manager.processar_nova_foto_usuario(request.user)
+                    success = facial_manager.processar_nova_foto_usuario(request.user)
                     
                     if success:
                         request.user.data_cadastro_facial = timezone.now()
@@ -367,13 +469,13 @@ def atualizar_foto_facial(request):
                         request.user.tentativas_falhas_facial = 0
                         
                         # Registra a atualização
-                        RegistroAcessoFacial.objects.create(
+                        registrar_acesso(
                             usuario=request.user,
                             tipo_acesso='atualizacao',
                             ip_origem=get_client_ip(request),
                             sucesso=True,
                             observacoes='Foto facial atualizada via upload',
-                            dispositivo=request.META.get('HTTP_USER_AGENT', '')[:200]
+                            dispositivo=get_client_device(request)
                         )
                         
                         messages.success(request, 'Foto facial atualizada e processada com sucesso!')
@@ -385,7 +487,11 @@ def atualizar_foto_facial(request):
             else:
                 messages.success(request, 'Foto salva com sucesso! (Processamento facial não disponível)')
             
-            request.user.save()
+            request.user.save(update_fields=[
+                'foto_perfil_facial', 'data_cadastro_facial',
+                'reconhecimento_facial_ativo', 'tentativas_falhas_facial',
+                'data_atualizacao'
+            ])
             return redirect('dashboard')
             
         except ValidationError as e:
@@ -424,13 +530,13 @@ def remover_foto_facial(request):
         request.user.save()
         
         # Registra a remoção
-        RegistroAcessoFacial.objects.create(
+        registrar_acesso(
             usuario=request.user,
             tipo_acesso='atualizacao',
             ip_origem=get_client_ip(request),
             sucesso=True,
             observacoes='Foto facial removida pelo usuário',
-            dispositivo=request.META.get('HTTP_USER_AGENT', '')[:200]
+            dispositivo=get_client_device(request)
         )
         
         messages.success(request, 'Foto facial removida com sucesso!')